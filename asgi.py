@@ -0,0 +1,369 @@
+import asyncio
+import logging
+import os
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from coalescer import AsyncBatchCoalescer
+from compression import choose_encoding, compress_async_stream
+from formatting import (IDCONV_TYPES, METADATA_FIELDS, REFERENCE_PROJECTION, identifier_updates,
+                        merge_identifier_results, parse_id_list, sample_id_query, sample_values)
+from hot_set import HotSet
+from indexes import require_indexes, required_indexes
+from idconv import Deadline
+from idconv_async import AsyncIdConvClient
+from lookups import (PUBLICATION_CURSOR_BATCH_SIZE, HotSetPreload, IdentifierLookup, PublicationQuery,
+                     PublicationStream, WarmupState, bulk_publication_args, identifier_args, identifier_batches,
+                     ids_by_fields, local_publications, log_saved_identifiers, ncbi_deadline, ncbi_results,
+                     publication_args, publication_cache_stats, publication_response, uncached_identifiers)
+from pub_ids import SAMPLE_KEY_RANGES
+from metrics import BATCH_IDS, REQUEST_SECONDS, exposition, record_identifier_ids, stage, timed_async_iteration
+from result_cache import publication_cache_from_environment, unknown_identifier_cache_from_environment
+from snapshot import snapshot_from_environment
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+if os.environ and 'connection_string' in os.environ:
+    client = AsyncIOMotorClient(os.environ['connection_string'])
+    db = client['test']
+else:
+    print('local db')
+    client = AsyncIOMotorClient()
+    db = client['local']
+collection = db['documentMetadata']
+reference = db['documentIds']
+publication_cache = publication_cache_from_environment()
+unknown_identifier_cache = unknown_identifier_cache_from_environment()
+idconv_client = None
+background_tasks = set()
+warmed_up = None
+warmup_state = WarmupState()
+snapshot = snapshot_from_environment()
+use_database = snapshot is None or os.environ.get('SNAPSHOT_MONGO_FALLBACK', '1') != '0'
+access_log = db['accessLog']
+hot_set = HotSet.from_environment() if use_database else None
+
+
+class RequestTimingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        t = time.perf_counter()
+        response = await call_next(request)
+        endpoint = request.scope.get('endpoint')
+        REQUEST_SECONDS.labels(endpoint.__name__ if endpoint else 'unknown', response.status_code).observe(
+            time.perf_counter() - t)
+        return response
+
+
+async def startup():
+    global idconv_client, warmed_up
+    idconv_client = AsyncIdConvClient.from_environment()
+    warmed_up = asyncio.Event()
+    if use_database and os.environ.get('REQUIRE_INDEXES', '1') != '0':
+        await check_indexes()
+    tasks = []
+    if os.environ.get('WARMUP_ON_START', '1') != '0':
+        tasks.append(warm_up())
+    if hot_set is not None:
+        tasks.append(flush_hot_set())
+    for coroutine in tasks:
+        task = asyncio.create_task(coroutine)
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def check_indexes():
+    """Refuses to start without the indexes in indexes.py. An unreachable database is left to the warm-up retries."""
+    try:
+        information = {name: await db[name].index_information() for name in required_indexes()}
+    except PyMongoError:
+        logging.exception('Could not check the indexes')
+        return
+    require_indexes(information)
+
+
+async def collect_sample_ids(count: int = 10) -> list[str]:
+    if snapshot is not None:
+        return snapshot.meta['sample_ids']
+    ids = []
+    for _, low, high in SAMPLE_KEY_RANGES:
+        query, projection = sample_id_query(low, high)
+        ids.extend(sample_values(await collection.find(query, projection).to_list(count), low, high, count))
+    return ids
+
+
+async def warm_up():
+    while True:
+        try:
+            if use_database:
+                connections = int(os.environ.get('WARMUP_CONNECTIONS', 8))
+                await asyncio.gather(*[client.admin.command('ping') for _ in range(connections)])
+            sample_ids = await collect_sample_ids()
+            await get_publications(sample_ids, route='warm_up')
+            if hot_set is not None:
+                await preload_hot_set()
+            warmup_state.finished(sample_ids)
+            warmed_up.set()
+            return
+        except Exception as error:
+            await asyncio.sleep(warmup_state.failed(error))
+
+
+async def preload_hot_set():
+    preload = HotSetPreload(hot_set, publication_cache)
+    if preload.size <= 0:
+        return
+    query, projection, sort = hot_set.top_query()
+    cursor = access_log.find(query, projection).sort(sort)
+    pub_ids = [document['_id'] for document in await cursor.to_list(preload.size)]
+    for pub_ids_batch in preload.batches(pub_ids):
+        preload.loaded(await get_publications(pub_ids_batch, route='preload', coalesce=False))
+
+
+async def flush_hot_set():
+    interval = float(os.environ.get('HOT_SET_FLUSH_SECONDS', 60))
+    while True:
+        await asyncio.sleep(interval)
+        counts = hot_set.drain()
+        if len(counts) == 0:
+            continue
+        try:
+            await access_log.bulk_write(hot_set.updates(counts), ordered=False)
+        except Exception:
+            logging.exception(f'Could not record {len(counts)} sampled accesses')
+
+
+async def shutdown():
+    await idconv_client.aclose()
+    client.close()
+
+
+async def health_check(request: Request):
+    try:
+        await asyncio.wait_for(warmed_up.wait(), float(os.environ.get('WARMUP_WAIT_SECONDS', 5)))
+    except asyncio.TimeoutError:
+        return JSONResponse({'ids': []}, status_code=503)
+    return JSONResponse({'ids': list(warmup_state.sample_ids)})
+
+
+async def liveness(request: Request):
+    return JSONResponse({'status': 'ok'})
+
+
+async def readiness(request: Request):
+    if not warmed_up.is_set():
+        return JSONResponse({'status': 'warming up', 'error': warmup_state.error}, status_code=503)
+    return JSONResponse({'status': 'ready'})
+
+
+async def get_version(request: Request):
+    return PlainTextResponse('0.1.0')
+
+
+async def get_metrics(request: Request):
+    body, content_type = exposition()
+    return Response(body, headers={'Content-Type': content_type})
+
+
+async def cache_stats(request: Request):
+    return JSONResponse(publication_cache_stats(publication_cache, publication_coalescer, hot_set))
+
+
+async def query_publications(pub_ids: list[str], fields: tuple = METADATA_FIELDS):
+    """Yields (pub_id, value) pairs as the cursor batches of each PublicationQuery query arrive."""
+    lookup = PublicationQuery(pub_ids, fields, publication_cache)
+    for query, projection in lookup.queries():
+        async for document in collection.find(query, projection).batch_size(PUBLICATION_CURSOR_BATCH_SIZE):
+            for pub_id, value in lookup.add(document):
+                yield pub_id, value
+
+
+async def fetch_coalesced_publications(keys: list[tuple]) -> dict:
+    results = {}
+    for fields, pub_ids in ids_by_fields(keys).items():
+        async for pub_id, document in query_publications(pub_ids, fields):
+            results[(fields, pub_id)] = document
+    return results
+
+
+publication_coalescer = AsyncBatchCoalescer(
+    fetch_coalesced_publications,
+    window_ms=float(os.environ.get('COALESCE_WINDOW_MS', 2)),
+    max_batch=int(os.environ.get('COALESCE_MAX_BATCH', 1000))
+)
+
+
+async def get_publications(pub_ids: list[str], fields: tuple = METADATA_FIELDS,
+                           route: str = 'publication_lookup', coalesce: bool = True) -> dict:
+    results, missing = local_publications(pub_ids, fields, route, publication_cache, hot_set, snapshot)
+    if len(missing) > 0 and use_database:
+        with stage(route, 'mongo'):
+            if coalesce:
+                fetched = await publication_coalescer.get_many([(fields, pub_id) for pub_id in missing])
+                results.update((pub_id, document) for (_, pub_id), document in fetched.items())
+            else:
+                async for pub_id, document in query_publications(missing, fields):
+                    results[pub_id] = document
+    return results
+
+
+async def iter_publications(pub_ids: list[str], fields: tuple, route: str):
+    """
+    Yields (pub_id, value) pairs as they are found: cached and snapshot results first, then Mongo documents as their
+    cursor batches arrive, bypassing the coalescer. The mongo stage times only the cursor iteration.
+    """
+    results, missing = local_publications(pub_ids, fields, route, publication_cache, hot_set, snapshot)
+    for pub_id, value in results.items():
+        yield pub_id, value
+    if len(missing) > 0 and use_database:
+        async for pub_id, value in timed_async_iteration(route, 'mongo', query_publications(missing, fields)):
+            yield pub_id, value
+
+
+async def publication_lookup(request: Request):
+    t = time.perf_counter()
+    route = 'publication_lookup'
+    with stage(route, 'normalize'):
+        try:
+            pub_ids, fields, request_id = publication_args(request.query_params)
+        except ValueError as error:
+            return JSONResponse({'error': str(error)}, status_code=400)
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    results = await get_publications(pub_ids, fields, route)
+    status, body, headers = publication_response(t, route, pub_ids, fields, results, request_id, hot_set,
+                                                 request.headers.get('if-none-match'),
+                                                 request.headers.get('accept-encoding'))
+    if status == 304:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+
+async def bulk_publication_lookup(request: Request):
+    t = time.perf_counter()
+    route = 'bulk_publication_lookup'
+    try:
+        body = await request.json()
+        pub_ids, fields, request_id = bulk_publication_args(body, request.query_params)
+    except ValueError as error:
+        return JSONResponse({'error': str(error)}, status_code=400)
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    stream = PublicationStream(route, pub_ids, hot_set)
+
+    async def generate():
+        for corrected_pub_ids in stream.batches():
+            async for pub_id, value in iter_publications(corrected_pub_ids, fields, route):
+                lines = stream.add(pub_id, value)
+                if len(lines) > 0:
+                    yield lines
+            lines = stream.flush()
+            if len(lines) > 0:
+                yield lines
+        yield stream.end(t, request_id)
+
+    encoding = choose_encoding(request.headers.get('accept-encoding'))
+    if encoding is None:
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+    return StreamingResponse(compress_async_stream(generate(), encoding), media_type='application/x-ndjson',
+                             headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+
+
+async def id_lookup(request: Request):
+    route = 'id_lookup'
+    try:
+        pub_ids = identifier_args(request.query_params)
+    except ValueError as error:
+        return JSONResponse({'error': str(error)}, status_code=400)
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    results_dict = await resolve_identifiers(pub_ids, ncbi_deadline(), route)
+    record_identifier_ids(route, len(pub_ids), results_dict)
+    with stage(route, 'render'):
+        return JSONResponse(results_dict)
+
+
+async def batch_id_lookup(request: Request):
+    route = 'batch_id_lookup'
+    try:
+        pub_ids = parse_id_list(await request.json())
+    except ValueError as error:
+        return JSONResponse({'error': str(error)}, status_code=400)
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    deadline = ncbi_deadline()
+    results_dict = {}
+    for pub_ids_batch in identifier_batches(pub_ids):
+        merge_identifier_results(results_dict, await resolve_identifiers(pub_ids_batch, deadline, route))
+    record_identifier_ids(route, len(pub_ids), results_dict)
+    with stage(route, 'render'):
+        return JSONResponse(results_dict)
+
+
+async def resolve_identifiers(pub_ids: list[str], deadline: Deadline, route: str = 'id_lookup') -> dict:
+    lookup = IdentifierLookup(pub_ids, route)
+    if lookup.query is None:
+        return {}
+    with stage(route, 'mongo'):
+        unfound = lookup.add_records(await find_reference_records(lookup))
+    with stage(route, 'ncbi'):
+        fallback_results = await asyncio.gather(*[lookup_identifiers(IDCONV_TYPES[id_type], unfound_ids, deadline)
+                                                  for id_type, unfound_ids in unfound.items()])
+    for id_type, (synonyms_dict, pending_ids) in zip(unfound, fallback_results):
+        lookup.add_ncbi_results(id_type, synonyms_dict, pending_ids)
+    return lookup.results()
+
+
+async def find_reference_records(lookup: IdentifierLookup) -> list[dict]:
+    if snapshot is None:
+        return await reference.find(lookup.query, REFERENCE_PROJECTION).to_list(None)
+    records, query = lookup.snapshot_records(snapshot)
+    if use_database and query is not None:
+        records.extend(await reference.find(query, REFERENCE_PROJECTION).to_list(None))
+    return records
+
+
+async def save_identifiers(records: list[dict]):
+    ops_list = identifier_updates(records)
+    if len(ops_list) == 0:
+        return
+    try:
+        log_saved_identifiers(len(ops_list), await reference.bulk_write(ops_list, ordered=False))
+    except Exception:
+        logging.exception('Could not save NCBI identifier records')
+
+
+async def lookup_identifiers(id_type: str, ids: list[str], deadline: Deadline = None) -> tuple[dict, list[str]]:
+    ids = uncached_identifiers(unknown_identifier_cache, id_type, ids)
+    if len(ids) == 0:
+        return {}, []
+    records, failed_ids = await idconv_client.convert(ids, id_type, deadline)
+    synonyms_dict, records, pending_ids = ncbi_results(unknown_identifier_cache, id_type, ids, records, failed_ids)
+    if len(records) > 0 and use_database:
+        task = asyncio.create_task(save_identifiers(records))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return synonyms_dict, pending_ids
+
+
+app = Starlette(
+    routes=[
+        Route('/', health_check),
+        Route('/livez', liveness),
+        Route('/readyz', readiness),
+        Route('/version', get_version),
+        Route('/cache', cache_stats),
+        Route('/metrics', get_metrics),
+        Route('/publications', publication_lookup, methods=['GET']),
+        Route('/publications', bulk_publication_lookup, methods=['POST']),
+        Route('/identifiers', id_lookup, methods=['GET']),
+        Route('/identifiers', batch_id_lookup, methods=['POST']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*']), Middleware(RequestTimingMiddleware)],
+    on_startup=[startup],
+    on_shutdown=[shutdown]
+)
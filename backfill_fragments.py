@@ -0,0 +1,62 @@
+import argparse
+import os
+
+from pymongo import MongoClient, UpdateOne
+
+from batching import batched
+from formatting import FRAGMENT_FIELD, METADATA_FIELDS, fragment_value
+from pub_ids import KEYS_FIELD, document_id_keys, reference_keys
+
+
+def backfill(db, batch_size=1000, dry_run=False):
+    collection = db['documentMetadata']
+    counts = {'rendered': 0, 'updated': 0, 'identifiers': 0}
+    projection = {'_id': 0, 'document_id': 1, 'aliases': 1} | {field: 1 for field in METADATA_FIELDS}
+    query = {'$or': [{FRAGMENT_FIELD: {'$exists': False}}, {KEYS_FIELD: {'$exists': False}}]}
+    cursor = collection.find(query, projection, no_cursor_timeout=True)
+    try:
+        for batch in batched(cursor, batch_size):
+            ops_list = [UpdateOne({'document_id': doc['document_id']}, {'$set': {
+                FRAGMENT_FIELD: fragment_value(doc),
+                KEYS_FIELD: document_id_keys(doc)
+            }}) for doc in batch]
+            counts['rendered'] += len(ops_list)
+            if not dry_run:
+                counts['updated'] += collection.bulk_write(ops_list, ordered=False).modified_count
+            print(counts)
+    finally:
+        cursor.close()
+    counts['identifiers'] = backfill_identifier_keys(db['documentIds'], batch_size, dry_run)
+    return counts
+
+
+def backfill_identifier_keys(reference, batch_size=1000, dry_run=False):
+    """Stores the typed keys /identifiers looks documentIds records up by on the records that lack them."""
+    count = 0
+    cursor = reference.find({KEYS_FIELD: {'$exists': False}}, {'_id': 1, 'PM': 1, 'PMC': 1, 'DOI': 1},
+                            no_cursor_timeout=True)
+    try:
+        for batch in batched(cursor, batch_size):
+            ops_list = [UpdateOne({'_id': record['_id']}, {'$set': {KEYS_FIELD: reference_keys(record)}})
+                        for record in batch]
+            count += len(ops_list)
+            if not dry_run:
+                reference.bulk_write(ops_list, ordered=False)
+            print({'identifiers': count})
+    finally:
+        cursor.close()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Store the pre-rendered JSON fragment and the typed ID keys on documentMetadata documents, and the '
+                    'typed ID keys on documentIds records, where they are missing')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true', help='report how many documents and records would be updated')
+    args = parser.parse_args()
+    if os.environ and 'connection_string' in os.environ:
+        database = MongoClient(os.environ['connection_string'])['test']
+    else:
+        database = MongoClient()['local']
+    print(backfill(database, args.batch_size, args.dry_run))
@@ -0,0 +1,28 @@
+from pymongo import DeleteMany
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def add_counts(totals, counts):
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            add_counts(totals.setdefault(key, {}), value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def delete_keys(target, keys, chunk_size):
+    if len(keys) == 0:
+        return 0
+    ops_list = [DeleteMany({'document_id': {'$in': chunk}}) for chunk in batched(keys, chunk_size)]
+    return target.bulk_write(ops_list, ordered=False).deleted_count
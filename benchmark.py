@@ -0,0 +1,292 @@
+import argparse
+import contextlib
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import string
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BATCH_SIZES = (10, 50, 100)
+DEFAULT_SLO_P90_MS = 150
+ENDPOINTS = ('publications', 'identifiers')
+
+
+class FakeIdConvHandler(BaseHTTPRequestHandler):
+    """Answers idconv requests like NCBI: every ID resolves to a PMC ID and a DOI, except IDs ending in 0."""
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        id_type = query['idtype'][0] if 'idtype' in query else 'pmid'
+        records = []
+        for pub_id in query['ids'][0].split(','):
+            if pub_id.endswith('0'):
+                records.append({id_type: pub_id, 'status': 'error', 'errmsg': 'invalid article id'})
+                continue
+            number = ''.join(character for character in pub_id if character.isdigit()) or '1'
+            records.append({'pmid': number, 'pmcid': 'PMC' + number, 'doi': f'10.9999/fake.{number}'} | {id_type: pub_id})
+        time.sleep(self.latency)
+        body = json.dumps({'status': 'ok', 'records': records}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def abstract_text(rng):
+    length = min(int(rng.lognormvariate(7.2, 0.5)), 8000)
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        words.append(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 12))))
+    return ' '.join(words)
+
+
+def synthetic_corpus(size, seed):
+    """
+    Yields (document, identifier record) pairs shaped like the loaded PubMed data: every article has a PMID,
+    about a third have a PMC ID and about 80% have a DOI, stored as aliases of the PMID document.
+    """
+    rng = random.Random(seed)
+    for number in range(1, size + 1):
+        pmid = str(10000000 + number)
+        record = {'PM': pmid, 'PMC': 'PMC' + str(5000000 + number) if rng.random() < 0.33 else '',
+                  'DOI': f'10.{rng.randint(1000, 9999)}/bench.{number}' if rng.random() < 0.8 else ''}
+        document = {
+            'document_id': 'PMID:' + pmid,
+            'journal_name': 'Journal of ' + rng.choice(['Biology', 'Medicine', 'Chemistry', 'Genetics']),
+            'journal_abbrev': rng.choice(['J Biol', 'J Med', 'J Chem', 'J Genet']),
+            'article_title': ' '.join(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+                                      for _ in range(rng.randint(6, 20))),
+            'volume': str(rng.randint(1, 300)),
+            'issue': str(rng.randint(1, 12)),
+            'pub_year': str(rng.randint(1970, 2023)),
+            'pub_month': rng.choice(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', '']),
+            'pub_day': str(rng.randint(1, 28)),
+            'abstract': abstract_text(rng) if rng.random() < 0.85 else ''
+        }
+        aliases = [alias for alias in (record['PMC'], record['DOI']) if alias]
+        if aliases:
+            document['aliases'] = aliases
+        yield document, record
+
+
+def seed_database(db, size, seed):
+    from formatting import FRAGMENT_FIELD, fragment_value
+    from indexes import ensure_indexes
+    from pub_ids import KEYS_FIELD, document_id_keys, reference_keys
+    documents = []
+    records = []
+    for document, record in synthetic_corpus(size, seed):
+        document[FRAGMENT_FIELD] = fragment_value(document)
+        document[KEYS_FIELD] = document_id_keys(document)
+        record[KEYS_FIELD] = reference_keys(record)
+        documents.append(document)
+        records.append(record)
+        if len(documents) == 5000:
+            db['documentMetadata'].insert_many(documents)
+            db['documentIds'].insert_many(records)
+            documents = []
+            records = []
+    if len(documents) > 0:
+        db['documentMetadata'].insert_many(documents)
+        db['documentIds'].insert_many(records)
+    ensure_indexes(db)
+
+
+def request_ids(corpus, rng, batch_size, missing_rate):
+    """Picks a batch of IDs in the prefixed forms clients send, with a share of IDs the database does not hold."""
+    pub_ids = []
+    for _ in range(batch_size):
+        if rng.random() < missing_rate:
+            pub_ids.append('PMID:' + str(rng.randint(90000000, 99999999)))
+            continue
+        record = rng.choice(corpus)
+        choices = ['PMID:' + record['PM']] + (['PMC:' + record['PMC'][3:]] if record['PMC'] else []) + \
+                  (['DOI:' + record['DOI']] if record['DOI'] else [])
+        pub_ids.append(rng.choice(choices))
+    return pub_ids
+
+
+def request_path(endpoint, pub_ids):
+    pub_ids = ','.join(urllib.parse.quote(pub_id, safe=':/') for pub_id in pub_ids)
+    if endpoint == 'publications':
+        return f'/publications?pubids={pub_ids}&request_id=benchmark'
+    return f'/identifiers?pubids={pub_ids}'
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def run_scenario(port, paths, concurrency):
+    local = threading.local()
+
+    def send(path):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        start = time.perf_counter()
+        try:
+            local.connection.request('GET', path)
+            response = local.connection.getresponse()
+            response.read()
+            succeeded = response.status == 200
+        except (http.client.HTTPException, OSError):
+            local.connection.close()
+            del local.connection
+            succeeded = False
+        return (time.perf_counter() - start) * 1000.0, succeeded
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(send, paths))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, succeeded in outcomes if succeeded]
+    return {
+        'requests': len(outcomes),
+        'errors': len(outcomes) - len(latencies),
+        'p50_ms': percentile(latencies, 0.5),
+        'p90_ms': percentile(latencies, 0.9),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': max(latencies) if latencies else None,
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'throughput_rps': len(outcomes) / elapsed if elapsed > 0 else None
+    }
+
+
+def copy_projections(collection):
+    """
+    mongomock pops keys off the projection it is given, which races on shared constants like REFERENCE_PROJECTION
+    when requests run concurrently, so the benchmark's collections get a find that passes a copy.
+    """
+    find = collection.find
+
+    def find_with_copied_projection(filter=None, projection=None, *args, **kwargs):
+        return find(filter, dict(projection) if isinstance(projection, dict) else projection, *args, **kwargs)
+
+    collection.find = find_with_copied_projection
+
+
+def start_api(args, ncbi_port):
+    os.environ['IDCONV_URL'] = f'http://127.0.0.1:{ncbi_port}'
+    os.environ.setdefault('IDCONV_REQUESTS_PER_SECOND', '1000')
+    os.environ['REQUIRE_INDEXES'] = '0'
+    if args.no_cache:
+        os.environ['CACHE_MAX_ENTRIES'] = '0'
+        os.environ['NCBI_NEGATIVE_CACHE_MAX_ENTRIES'] = '0'
+    if args.mongo_uri:
+        os.environ['connection_string'] = args.mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('benchmark.py needs mongomock (pip install -r requirements-dev.txt) or --mongo-uri for a local mongod')
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    import main
+    if not args.mongo_uri:
+        for collection in (main.collection, main.reference, main.access_log):
+            copy_projections(collection)
+    from werkzeug.serving import make_server
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('opentelemetry').setLevel(logging.CRITICAL)
+    if args.mongo_uri and main.collection.estimated_document_count() > 0:
+        sys.exit('The --mongo-uri database already holds documents; point the benchmark at an empty one')
+    seed_database(main.db, args.corpus_size, args.seed)
+    server = start_server(make_server('127.0.0.1', 0, main.app, threaded=True))
+    return main, server
+
+
+def benchmark(args):
+    FakeIdConvHandler.latency = args.ncbi_latency_ms / 1000.0
+    ncbi_server = start_server(ThreadingHTTPServer(('127.0.0.1', 0), FakeIdConvHandler))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        main, api_server = start_api(args, ncbi_server.server_port)
+        corpus = [record for _, record in synthetic_corpus(args.corpus_size, args.seed)]
+        rng = random.Random(args.seed)
+        scenarios = []
+        for endpoint in args.endpoints:
+            for batch_size in args.batch_sizes:
+                paths = [request_path(endpoint, request_ids(corpus, rng, batch_size, args.missing_rate))
+                         for _ in range(args.warmup + args.requests)]
+                run_scenario(api_server.server_port, paths[:args.warmup], args.concurrency)
+                result = run_scenario(api_server.server_port, paths[args.warmup:], args.concurrency)
+                result['ids_per_second'] = result['throughput_rps'] * batch_size if result['throughput_rps'] else None
+                scenarios.append({'endpoint': endpoint, 'batch_size': batch_size,
+                                  'concurrency': args.concurrency} | result)
+        cache = main.publication_cache.stats()
+    api_server.shutdown()
+    ncbi_server.shutdown()
+    report = {
+        'settings': {
+            'corpus_size': args.corpus_size,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'missing_rate': args.missing_rate,
+            'ncbi_latency_ms': args.ncbi_latency_ms,
+            'cache': not args.no_cache,
+            'database': 'mongod' if args.mongo_uri else 'mongomock',
+            'seed': args.seed
+        },
+        'scenarios': scenarios,
+        'cache': cache
+    }
+    slo_p90_ms = args.slo_p90_ms if args.slo_p90_ms is not None else DEFAULT_SLO_P90_MS if args.mongo_uri else 0
+    if slo_p90_ms:
+        report['slo'] = {
+            'p90_ms': slo_p90_ms,
+            'passed': all(scenario['p90_ms'] is not None and scenario['p90_ms'] <= slo_p90_ms
+                          and scenario['errors'] == 0 for scenario in scenarios)
+        }
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark /publications and /identifiers against a synthetic corpus and a fake NCBI ID converter')
+    parser.add_argument('--corpus-size', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and batch size')
+    parser.add_argument('--warmup', type=int, default=20, help='requests sent before each measured run')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=list(BATCH_SIZES))
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--missing-rate', type=float, default=0.05,
+                        help='share of requested IDs that are not in the corpus (they reach the NCBI fallback)')
+    parser.add_argument('--ncbi-latency-ms', type=float, default=50)
+    parser.add_argument('--no-cache', action='store_true', help='disable the server-side result caches')
+    parser.add_argument('--mongo-uri', help='seed and use this (throwaway) database instead of mongomock')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--slo-p90-ms', type=float,
+                        help=f'fail when any scenario p90 exceeds this (0 to skip); defaults to {DEFAULT_SLO_P90_MS} '
+                             'with --mongo-uri, and to no check against mongomock')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+    report = benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if 'slo' in report and not report['slo']['passed']:
+        sys.exit(1)
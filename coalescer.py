@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchCoalescer:
+    """
+    Merges concurrent lookups into shared batches.
+
+    Keys that are already being fetched by another thread are not fetched again; the caller waits on the
+    in-flight result instead (single-flight). New keys are collected for window_ms milliseconds by the first
+    thread to arrive, which then calls fetch once for everything collected (at most max_batch keys per call)
+    on behalf of every waiting thread. fetch takes a list of keys and returns a dict holding the keys it found.
+    """
+
+    def __init__(self, fetch, window_ms: float = 2, max_batch: int = 1000):
+        self.fetch = fetch
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._pending = []
+        self._leader_active = False
+        self.batches = 0
+        self.keys_fetched = 0
+        self.keys_shared = 0
+
+    def get_many(self, keys) -> dict:
+        futures = {}
+        is_leader = False
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                future = self._inflight.get(key)
+                if future is None:
+                    future = Future()
+                    self._inflight[key] = future
+                    self._pending.append(key)
+                else:
+                    self.keys_shared += 1
+                futures[key] = future
+            if len(self._pending) > 0 and not self._leader_active:
+                self._leader_active = True
+                is_leader = True
+        if is_leader:
+            self._lead()
+        results = {}
+        for key, future in futures.items():
+            value = future.result()
+            if value is not None:
+                results[key] = value
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'keys_fetched': self.keys_fetched,
+                'keys_shared': self.keys_shared,
+                'inflight': len(self._inflight)
+            }
+
+    def _lead(self):
+        if self.window > 0:
+            time.sleep(self.window)
+        with self._lock:
+            keys = self._pending
+            self._pending = []
+            self._leader_active = False
+            self.batches += (len(keys) + self.max_batch - 1) // self.max_batch
+            self.keys_fetched += len(keys)
+        for start in range(0, len(keys), self.max_batch):
+            batch = keys[start:start + self.max_batch]
+            try:
+                values = self.fetch(batch)
+            except Exception as error:
+                self._resolve(batch, error=error)
+            else:
+                self._resolve(batch, values)
+
+    def _resolve(self, keys, values=None, error=None):
+        with self._lock:
+            futures = [(key, self._inflight.pop(key)) for key in keys]
+        for key, future in futures:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(values.get(key))
+
+
+class AsyncBatchCoalescer:
+    """
+    The asyncio counterpart of BatchCoalescer, for lookups on a single event loop; fetch is a coroutine function.
+
+    The batch is fetched by its own task rather than by the first caller, so a cancelled request does not strand the
+    requests waiting on its keys, and each caller waits on shielded futures for the same reason.
+    """
+
+    def __init__(self, fetch, window_ms: float = 2, max_batch: int = 1000):
+        self.fetch = fetch
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._inflight = {}
+        self._pending = []
+        self._leader = None
+        self.batches = 0
+        self.keys_fetched = 0
+        self.keys_shared = 0
+
+    async def get_many(self, keys) -> dict:
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for key in dict.fromkeys(keys):
+            future = self._inflight.get(key)
+            if future is None:
+                future = loop.create_future()
+                self._inflight[key] = future
+                self._pending.append(key)
+            else:
+                self.keys_shared += 1
+            futures[key] = future
+        if len(self._pending) > 0 and self._leader is None:
+            self._leader = loop.create_task(self._lead())
+        results = {}
+        for key, future in futures.items():
+            value = await asyncio.shield(future)
+            if value is not None:
+                results[key] = value
+        return results
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'keys_fetched': self.keys_fetched,
+            'keys_shared': self.keys_shared,
+            'inflight': len(self._inflight)
+        }
+
+    async def _lead(self):
+        if self.window > 0:
+            await asyncio.sleep(self.window)
+        keys = self._pending
+        self._pending = []
+        self._leader = None
+        self.batches += (len(keys) + self.max_batch - 1) // self.max_batch
+        self.keys_fetched += len(keys)
+        for start in range(0, len(keys), self.max_batch):
+            batch = keys[start:start + self.max_batch]
+            try:
+                values = await self.fetch(batch)
+            except Exception as error:
+                self._resolve(batch, error=error)
+            else:
+                self._resolve(batch, values)
+
+    def _resolve(self, keys, values=None, error=None):
+        for key in keys:
+            future = self._inflight.pop(key)
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(values.get(key))
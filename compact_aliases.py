@@ -0,0 +1,98 @@
+import argparse
+import os
+
+from pymongo import MongoClient, UpdateOne
+
+from batching import batched
+from formatting import UPDATED_FIELD, utc_now
+from idconv import IdConvClient
+from pub_ids import KEYS_FIELD, document_id_keys, id_type, pmid_document_id, pmid_number
+
+
+def add_aliases(collection, aliases_dict, dry_run):
+    now = utc_now()
+    ops_list = [UpdateOne({'document_id': document_id}, {'$addToSet': {
+                    'aliases': {'$each': aliases},
+                    KEYS_FIELD: {'$each': document_id_keys({'document_id': document_id, 'aliases': aliases})}
+                }, '$set': {UPDATED_FIELD: now}}) for document_id, aliases in aliases_dict.items() if len(aliases) > 0]
+    copy_ids = [alias for aliases in aliases_dict.values() for alias in aliases]
+    if dry_run or len(ops_list) == 0:
+        return len(copy_ids), 0
+    collection.bulk_write(ops_list, ordered=False)
+    deleted = collection.delete_many({'document_id': {'$in': copy_ids}}).deleted_count
+    return len(copy_ids), deleted
+
+
+def compact_canonical_documents(collection, reference, batch_size, dry_run):
+    counts = {'canonical': 0, 'aliases': 0, 'copies_deleted': 0}
+    cursor = collection.find({'document_id': {'$regex': '^PMID'}}, {'_id': 0, 'document_id': 1}, no_cursor_timeout=True)
+    try:
+        for batch in batched(cursor, batch_size):
+            pmids = [pmid_number(doc['document_id']) for doc in batch]
+            aliases_dict = {}
+            for record in reference.find({'PM': {'$in': pmids}}, {'_id': 0, 'PM': 1, 'PMC': 1, 'DOI': 1}):
+                aliases = [record[key] for key in ('PMC', 'DOI') if key in record and record[key]]
+                aliases_dict[pmid_document_id(record['PM'])] = aliases
+            alias_count, deleted = add_aliases(collection, aliases_dict, dry_run)
+            counts['canonical'] += len(batch)
+            counts['aliases'] += alias_count
+            counts['copies_deleted'] += deleted
+            print(counts)
+    finally:
+        cursor.close()
+    return counts
+
+
+def compact_orphan_copies(collection, idconv_client, batch_size, dry_run):
+    counts = {'orphans': 0, 'orphans_resolved': 0, 'orphan_copies_deleted': 0}
+    cursor = collection.find({'document_id': {'$not': {'$regex': '^PMID'}}}, {'_id': 0, 'document_id': 1},
+                             no_cursor_timeout=True)
+    try:
+        for batch in batched(cursor, batch_size):
+            orphan_ids = [doc['document_id'] for doc in batch]
+            counts['orphans'] += len(orphan_ids)
+            aliases_dict = {}
+            for idconv_type, ids in (('pmcid', [x for x in orphan_ids if id_type(x) == 'pmc']),
+                                     ('doi', [x for x in orphan_ids if id_type(x) == 'doi'])):
+                records, _ = idconv_client.convert(ids, idconv_type)
+                for record in records:
+                    if 'pmid' not in record or ('status' in record and record['status'] == 'error'):
+                        continue
+                    alias = record['requested-id'] if 'requested-id' in record else record.get(idconv_type, '')
+                    aliases_dict.setdefault(pmid_document_id(record['pmid']), []).append(alias)
+            canonical_ids = set(doc['document_id'] for doc in collection.find(
+                {'document_id': {'$in': list(aliases_dict.keys())}}, {'_id': 0, 'document_id': 1}))
+            aliases_dict = {key: value for key, value in aliases_dict.items() if key in canonical_ids}
+            alias_count, deleted = add_aliases(collection, aliases_dict, dry_run)
+            counts['orphans_resolved'] += alias_count
+            counts['orphan_copies_deleted'] += deleted
+            print(counts)
+    finally:
+        cursor.close()
+    return counts
+
+
+def compact(db, batch_size=1000, dry_run=False, orphans=True):
+    collection = db['documentMetadata']
+    reference = db['documentIds']
+    if not dry_run:
+        collection.create_index(KEYS_FIELD)
+    results = compact_canonical_documents(collection, reference, batch_size, dry_run)
+    if orphans:
+        results |= compact_orphan_copies(collection, IdConvClient.from_environment(), batch_size, dry_run)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert PMC and DOI copies in documentMetadata into aliases of the canonical PMID document')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing')
+    parser.add_argument('--skip-orphans', action='store_true',
+                        help='do not resolve copies missing from documentIds through the NCBI ID converter')
+    args = parser.parse_args()
+    if os.environ and 'connection_string' in os.environ:
+        database = MongoClient(os.environ['connection_string'])['test']
+    else:
+        database = MongoClient()['local']
+    print(compact(database, args.batch_size, args.dry_run, not args.skip_orphans))
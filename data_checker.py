@@ -1,82 +1,163 @@
 import boto3
 import gzip
+import heapq
+import io
+import itertools
 import json
 import os
-from math import ceil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
 
+from batching import batched
+from pub_ids import pmid_document_id, pmid_number
 
-def load_file(filepath):
-    documents = {}
-    lines = open(filepath, 'r').read().splitlines()
+
+def parse_manifest(lines):
     for line in lines:
-        columns = line.split('\t')
-        documents[columns[0]] = columns[1]
-    return documents
-
-
-def get_document_dict(remote_bucket, remote_filename):
-    with open('/tmp/source.gz', 'wb') as dest:
-        gcp_client.download_fileobj(remote_bucket, remote_filename, dest)
-    with gzip.open('/tmp/source.gz', 'rb') as gzfile:
-        byte_contents = gzfile.read()
-        with open('/tmp/source.tsv', 'wb') as tsvfile:
-            count = tsvfile.write(byte_contents)
-    return load_file('/tmp/source.tsv')
-
-
-
-def check_existence(document_dict):
-    id_list = ['PMID:' + document_id for document_id in document_dict.keys()]
-    print(id_list[:10])
-    print(len(id_list))
-    found_ids = []
-    subs = ceil(len(id_list) / 10000)
-    for i in range(subs):
-        start = i * 10000
-        end = min(start + 10000, len(id_list))
-        sublist = [doc['document_id'] for doc in collection.find({'document_id': {'$in': id_list[start:end]}})]
-        found_ids.extend(sublist)
-        print(f'{len(sublist)} | {len(found_ids)}')
-    unfound_ids = set(id_list) - set(found_ids)
-    print(len(unfound_ids))
-    missing_dict = {}
-    for unfound_id in unfound_ids:
-        document_id = unfound_id.replace('PMID:', '')
-        if document_id not in document_dict:
-            print('not sure what to do with this ID: ' + document_id)
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) < 2:
             continue
-        filename = document_dict[document_id]
-        if filename not in missing_dict:
-            missing_dict[filename] = []
-        missing_dict[filename].append(document_id)
-    return missing_dict
-
-
-def check_nonexistence(document_dict):
-    id_list = ['PMID:' + document_id for document_id in document_dict.keys()]
-    print(id_list[:10])
-    print(len(id_list))
-    found_ids = []
-    subs = ceil(len(id_list) / 10000)
-    for i in range(subs):
-        start = i * 10000
-        end = min(start + 10000, len(id_list))
-        sublist = [doc['document_id'] for doc in collection.find({'document_id': {'$in': id_list[start:end]}})]
-        found_ids.extend(sublist)
-        print(f'{len(sublist)} | {len(found_ids)}')
-    print(len(found_ids))
-    found_dict = {}
-    for found_id in found_ids:
-        document_id = found_id.replace('PMID:', '')
-        if document_id not in document_dict:
-            print('not sure what to do with this ID:' + document_id)
-            continue
-        filename = document_dict[document_id]
-        if filename not in found_dict:
-            found_dict[filename] = []
-        found_dict[filename].append(document_id)
-    return found_dict
+        yield columns[0], columns[1]
+
+
+def load_file(filepath):
+    with open(filepath, 'r') as infile:
+        return dict(parse_manifest(infile))
+
+
+def open_manifest(remote_bucket, remote_filename):
+    response = gcp_client.get_object(Bucket=remote_bucket, Key=remote_filename)
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=response['Body'], mode='rb'), encoding='utf-8')
+
+
+def find_existing(id_list):
+    projection = {'_id': 0, 'document_id': 1}
+    return set(doc['document_id'] for doc in collection.find({'document_id': {'$in': id_list}}, projection))
+
+
+def check_chunk(entries, expect_present):
+    found_ids = find_existing([pmid_document_id(document_id) for document_id, _ in entries])
+    results = {}
+    for document_id, filename in entries:
+        if (pmid_document_id(document_id) in found_ids) != expect_present:
+            results.setdefault(filename, []).append(document_id)
+    return len(entries), len(found_ids), results
+
+
+def merge_results(totals, results):
+    for filename, document_ids in results.items():
+        totals.setdefault(filename, []).extend(document_ids)
+
+
+def check_manifest(entries, expect_present=True, batch_size=10000, workers=None):
+    if not workers:
+        workers = int(os.environ.get('CHECKER_WORKERS', 8))
+    totals = {}
+    checked = 0
+    found = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in batched(entries, batch_size):
+            pending.append(executor.submit(check_chunk, chunk, expect_present))
+            while len(pending) >= workers * 2 or (pending and pending[0].done()):
+                chunk_count, found_count, results = pending.popleft().result()
+                checked += chunk_count
+                found += found_count
+                merge_results(totals, results)
+                print(f'{found} | {checked}')
+        while pending:
+            chunk_count, found_count, results = pending.popleft().result()
+            checked += chunk_count
+            found += found_count
+            merge_results(totals, results)
+    print(f'{found} of {checked} IDs found')
+    return totals
+
+
+def stream_document_ids(batch_size=50000):
+    """
+    All PMID document IDs in order. The merge can pause between batches for longer than the server's idle cursor
+    timeout, so the cursor has none and is closed with the generator instead.
+    """
+    cursor = collection.find({'document_id': {'$regex': '^PMID:'}}, {'_id': 0, 'document_id': 1},
+                             no_cursor_timeout=True)
+    try:
+        for doc in cursor.sort('document_id', 1).batch_size(batch_size):
+            yield doc['document_id']
+    finally:
+        cursor.close()
+
+
+def write_run(entries):
+    """Sorts one run of (document_id, filename) entries into a gzip-compressed temporary file."""
+    run = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=run, mode='wb', compresslevel=1) as outfile:
+        outfile.writelines(f'{key}\t{filename}\n'.encode() for key, filename in sorted(entries))
+    run.seek(0)
+    return run
+
+
+def read_run(run):
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=run, mode='rb'), encoding='utf-8') as infile:
+        for line in infile:
+            key, filename = line.rstrip('\n').split('\t')
+            yield key, filename
+
+
+def sort_manifest(entries, run_size=None):
+    """
+    Sorts the manifest externally: runs of run_size entries are sorted and spilled to temporary files, then merged,
+    so memory stays at one run. Repeated manifest lines are yielded once.
+    """
+    if not run_size:
+        run_size = int(os.environ.get('CHECKER_SORT_RUN_SIZE', 1000000))
+    keyed_entries = ((pmid_document_id(document_id), filename) for document_id, filename in entries)
+    runs = [write_run(chunk) for chunk in batched(keyed_entries, run_size)]
+    print(f'manifest sorted in {len(runs)} runs')
+    try:
+        previous = None
+        for entry in heapq.merge(*[read_run(run) for run in runs]):
+            if entry != previous:
+                yield entry
+            previous = entry
+    finally:
+        for run in runs:
+            run.close()
+
+
+def check_manifest_sorted(entries, expect_present=True):
+    totals = {}
+    sorted_entries = sort_manifest(entries)
+    # The first entry is only available once the whole manifest has been spilled, so the cursor opens after that.
+    first_entry = next(sorted_entries, None)
+    if first_entry is None:
+        return totals
+    stored_ids = stream_document_ids()
+    try:
+        stored_id = next(stored_ids, None)
+        for key, filename in itertools.chain([first_entry], sorted_entries):
+            while stored_id is not None and stored_id < key:
+                stored_id = next(stored_ids, None)
+            if (stored_id == key) != expect_present:
+                totals.setdefault(filename, []).append(pmid_number(key))
+    finally:
+        stored_ids.close()
+        sorted_entries.close()
+    return totals
+
+
+def check_existence(document_entries, sorted_merge=False):
+    if sorted_merge:
+        return check_manifest_sorted(document_entries, True)
+    return check_manifest(document_entries, True)
+
+
+def check_nonexistence(document_entries, sorted_merge=False):
+    if sorted_merge:
+        return check_manifest_sorted(document_entries, False)
+    return check_manifest(document_entries, False)
 
 
 def lambda_handler(event, context):
@@ -102,7 +183,9 @@ def lambda_handler(event, context):
     )
     db = client['test']
     collection = db['documentMetadata']
-    main_dict = get_document_dict(source_info['bucket'], source_info['filepath'])
-    if 'deleted' in source_info['filepath']:
-        return check_nonexistence(main_dict)
-    return check_existence(main_dict)
+    sorted_merge = source_info.get('mode') == 'merge'
+    with open_manifest(source_info['bucket'], source_info['filepath']) as manifest:
+        entries = parse_manifest(manifest)
+        if 'deleted' in source_info['filepath']:
+            return check_nonexistence(entries, sorted_merge)
+        return check_existence(entries, sorted_merge)
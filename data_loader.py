@@ -1,118 +1,155 @@
-import http.client
-
+import argparse
 import boto3
 import gzip
+import hashlib
+import io
 import json
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import botocore.exceptions
 from pymongo import MongoClient, UpdateOne
 from botocore.config import Config
 
+from batching import add_counts, batched, delete_keys
+from formatting import FRAGMENT_FIELD, METADATA_FIELDS, UPDATED_FIELD, fragment_value, utc_now
+from idconv import IdConvClient
+from pub_ids import KEYS_FIELD, document_id_keys, id_type, pmid_number
+
+idconv_client = IdConvClient.from_environment()
+mongo_client = None
+gcp_clients = {}
+
 
 def get_synonyms(document_ids):
+    """Synonyms by PMID from documentIds, then the ID converter, and the PMIDs whose converter lookup failed."""
     syn_dict = {}
     for doc in reference.find({'PM': {'$in': document_ids}}):
         syn_dict[doc['PM']] = [doc['PMC'] if 'PMC' in doc else '', doc['DOI'] if 'DOI' in doc else '']
     id_set = set(document_ids)
-    lookup_dict = lookup_synonyms(list(id_set - syn_dict.keys()))
-    return syn_dict | lookup_dict
+    lookup_dict, unresolved_ids = lookup_synonyms(list(id_set - syn_dict.keys()))
+    return syn_dict | lookup_dict, unresolved_ids
 
 
-def lookup_synonyms(ids: list[str], sublist_size: int = 200) -> dict:
+def lookup_synonyms(ids: list[str]) -> tuple[dict, list[str]]:
     synonyms_dict = {}
-    start_index = sublist_size
-    end_index = len(ids)
-    extra = end_index % sublist_size
-    for cap in range(start_index, end_index, sublist_size):
-        connection = http.client.HTTPConnection('www.ncbi.nlm.nih.gov')
-        id_sublist = ids[cap - sublist_size: cap]
-        numerical_ids = [x.replace('PMID:', '') for x in id_sublist]
-        request_string = f'/pmc/utils/idconv/v1.0/?ids={",".join(numerical_ids)}'
-        request_string += '&format=json&versions=no&tool=documentmetadataapi&email=edgargaticacu@gmail.com'
-        connection.request('GET', request_string)
-        response = connection.getresponse()
-        if response.status == 200:
-            response_text = response.read()
-            response_data = json.loads(response_text)
-            if 'records' in response_data:
-                for record in response_data['records']:
-                    synonyms_dict[record['pmid']] = [record['pmcid'] if 'pmcid' in record else '',
-                                                     record['doi'] if 'doi' in record else '']
-    id_sublist = ids[-extra:]
-    numerical_ids = [x.replace('PMID:', '') for x in id_sublist]
-    connection = http.client.HTTPConnection('www.ncbi.nlm.nih.gov')
-    request_string = f'/pmc/utils/idconv/v1.0/?ids={",".join(numerical_ids)}'
-    request_string += '&format=json&versions=no&tool=documentmetadataapi&email=edgargaticacu@gmail.com'
-    connection.request('GET', request_string)
-    response = connection.getresponse()
-    if response.status == 200:
-        response_text = response.read()
-        response_data = json.loads(response_text)
-        if 'records' in response_data:
-            for record in response_data['records']:
-                synonyms_dict[record['pmid']] = [record['pmcid'] if 'pmcid' in record else '',
-                                                 record['doi'] if 'doi' in record else '']
-    return synonyms_dict
+    numerical_ids = [pmid_number(x) for x in ids]
+    records, unresolved_ids = idconv_client.convert(numerical_ids)
+    if len(unresolved_ids) > 0:
+        print(f'Could not look up synonyms for {len(unresolved_ids)} IDs')
+    for record in records:
+        if 'pmid' not in record or ('status' in record and record['status'] == 'error'):
+            continue
+        synonyms_dict[record['pmid']] = [record['pmcid'] if 'pmcid' in record else '',
+                                         record['doi'] if 'doi' in record else '']
+    return synonyms_dict, unresolved_ids
 
 
 def get_existing_documents(document_ids):
     return [doc['document_id'] for doc in collection.find({'document_id': {'$in': document_ids}})]
 
 
+def get_aliases(document_id, synonyms_dict):
+    pmid = pmid_number(document_id)
+    if pmid not in synonyms_dict:
+        return None
+    return [alias for alias in synonyms_dict[pmid] if alias and len(alias) > 0]
+
+
 def insert_new_documents(pubmed_documents, synonyms_dict):
-    other_documents = []
+    alias_count = 0
+    now = utc_now()
     for doc in pubmed_documents:
-        pm = doc['document_id']
-        pmc_id = synonyms_dict[pm]['PMC']
-        doi = synonyms_dict[pm]['DOI']
-        if pmc_id and len(pmc_id) > 0:
-            pmc_record = doc.copy()
-            pmc_record['document_id'] = pmc_id
-            other_documents.append(pmc_record)
-        if doi and len(doi) > 0:
-            doi_record = doc.copy()
-            doi_record['document_id'] = doi
-            other_documents.append(doi_record)
+        aliases = get_aliases(doc['document_id'], synonyms_dict)
+        doc['content_hash'] = fingerprint(doc, aliases)
+        doc[FRAGMENT_FIELD] = fragment_value(doc)
+        doc[UPDATED_FIELD] = now
+        if aliases:
+            doc['aliases'] = aliases
+            alias_count += len(aliases)
+        doc[KEYS_FIELD] = document_id_keys(doc)
     result = collection.insert_many(pubmed_documents)
-    print(f'Inserted {len(pubmed_documents)} new PubMed documents')
+    print(f'Inserted {len(pubmed_documents)} new PubMed documents with {alias_count} aliases')
     print(result)
-    result = collection.insert_many(other_documents)
-    print(f'Inserted {len(other_documents)} non-PubMed documents')
-    print(result)
-    return {'pubmed': len(pubmed_documents), 'other': len(other_documents)}
+    return {'pubmed': len(pubmed_documents), 'other': alias_count}
+
 
+def fingerprint(doc, aliases):
+    content = [doc[field] if field in doc else '' for field in METADATA_FIELDS]
+    content.append(sorted(aliases) if aliases else [])
+    return hashlib.sha1(json.dumps(content, ensure_ascii=False).encode('utf-8')).hexdigest()
 
-def upsert_documents(pubmed_documents, synonyms_dict):
+
+def get_existing_fingerprints(document_ids):
+    projection = {'_id': 0, 'document_id': 1, 'content_hash': 1, 'aliases': 1}
+    return {doc['document_id']: doc for doc in collection.find({'document_id': {'$in': document_ids}}, projection)}
+
+
+def upsert_documents(pubmed_documents, synonyms_dict, unresolved_ids=()):
+    """
+    Writes the new and changed documents. Documents whose synonyms could not be looked up (unresolved_ids) are
+    written without a content_hash, so the next run sees them as changed and looks their synonyms up again.
+    """
     if len(pubmed_documents) == 0:
-        return {'pubmed': 0, 'other': 0}
+        return {'pubmed': 0, 'pmc': 0, 'doi': 0, 'new': 0, 'changed': 0, 'unchanged': 0, 'unresolved': 0}
+    unresolved_ids = set(unresolved_ids)
+    unresolved_count = 0
     pm_count = len(pubmed_documents)
     pmc_count = 0
     doi_count = 0
+    new_count = 0
+    changed_count = 0
     ops_list = []
+    now = utc_now()
+    existing_documents = get_existing_fingerprints([doc['document_id'] for doc in pubmed_documents])
     for doc in pubmed_documents:
         pm = doc['document_id']
-        pmid = pm.split(':')[-1]
+        pmid = pmid_number(pm)
         pmc_id = synonyms_dict[pmid][0] if pmid in synonyms_dict else ''
         doi = synonyms_dict[pmid][1] if pmid in synonyms_dict else ''
-        ops_list.append(UpdateOne({'document_id': pm}, {'$set': doc}, upsert=True))
+        existing = existing_documents[pm] if pm in existing_documents else None
+        aliases = get_aliases(pm, synonyms_dict)
+        content_hash = fingerprint(doc, aliases if aliases is not None else existing.get('aliases') if existing else None)
+        if existing and existing.get('content_hash') == content_hash:
+            continue
+        if existing:
+            changed_count += 1
+        else:
+            new_count += 1
+        doc = doc | {'content_hash': content_hash, FRAGMENT_FIELD: fragment_value(doc), UPDATED_FIELD: now}
+        if aliases is not None:
+            doc['aliases'] = aliases
+        stored_aliases = aliases if aliases is not None else existing.get('aliases', []) if existing else []
+        doc[KEYS_FIELD] = document_id_keys(doc | {'aliases': stored_aliases})
+        if pmid in unresolved_ids:
+            unresolved_count += 1
+            del doc['content_hash']
+            ops_list.append(UpdateOne({'document_id': pm}, {'$set': doc, '$unset': {'content_hash': ''}}, upsert=True))
+        else:
+            ops_list.append(UpdateOne({'document_id': pm}, {'$set': doc}, upsert=True))
         if pmc_id and len(pmc_id) > 0:
             pmc_count += 1
-            pmc_doc = doc.copy()
-            pmc_doc['document_id'] = pmc_id
-            ops_list.append(UpdateOne({'document_id': pmc_id}, {'$set': pmc_doc}, upsert=True))
         if doi and len(doi) > 0:
             doi_count += 1
-            doi_doc = doc.copy()
-            doi_doc['document_id'] = doi
-            ops_list.append(UpdateOne({'document_id': doi}, {'$set': doi_doc}, upsert=True))
-    result = collection.bulk_write(ops_list, ordered=False)
-    print(f'Updated {pm_count} PubMed documents')
-    print(f'Updated {pmc_count} PubMedCentral documents')
-    print(f'Updated {doi_count} DOI documents')
-    return {
-        'pubmed': pm_count,
+    unchanged_count = pm_count - new_count - changed_count
+    print(f'{new_count} new, {changed_count} changed, {unchanged_count} unchanged PubMed documents')
+    counts = {
+        'pubmed': new_count + changed_count,
         'pmc': pmc_count,
         'doi': doi_count,
+        'new': new_count,
+        'changed': changed_count,
+        'unchanged': unchanged_count,
+        'unresolved': unresolved_count
+    }
+    if len(ops_list) == 0:
+        return counts
+    result = collection.bulk_write(ops_list, ordered=False)
+    print(f'Updated {new_count + changed_count} PubMed documents')
+    print(f'Updated {pmc_count} PubMedCentral aliases')
+    print(f'Updated {doi_count} DOI aliases')
+    return counts | {
         'results': {
             'matched': result.matched_count,
             'upsert': result.upserted_count,
@@ -121,74 +158,270 @@ def upsert_documents(pubmed_documents, synonyms_dict):
     }
 
 
-def delete_existing_documents(document_ids):
-    return collection.delete_many({'document_id': {'$in': document_ids}}).deleted_count
+def get_alias_keys(document_ids):
+    """The PMC and DOI keys of the given PMID documents, from documentIds and from their stored aliases."""
+    keys = {'pmc': set(), 'doi': set()}
+    pmids = [pmid_number(document_id) for document_id in document_ids]
+    for record in reference.find({'PM': {'$in': pmids}}, {'_id': 0, 'PMC': 1, 'DOI': 1}):
+        for field in ('PMC', 'DOI'):
+            if field in record and record[field]:
+                keys[field.lower()].add(record[field])
+    for doc in collection.find({'document_id': {'$in': document_ids}}, {'_id': 0, 'aliases': 1}):
+        for alias in doc.get('aliases', []):
+            keys[id_type(alias)].add(alias)
+    return keys
+
+
+def delete_existing_documents(document_ids, chunk_size=None):
+    """
+    Deletes the PMID documents and any PMC or DOI copies left by older loader versions, in chunked unordered bulk
+    deletes, and counts the deleted documents per key type.
+    """
+    if not chunk_size:
+        chunk_size = int(os.environ.get('DELETE_CHUNK_SIZE', 1000))
+    alias_keys = get_alias_keys(document_ids)
+    counts = {'pubmed': delete_keys(collection, document_ids, chunk_size)}
+    for key_type, keys in alias_keys.items():
+        counts[key_type] = delete_keys(collection, sorted(keys), chunk_size)
+    return counts
+
+
+def parse_line(line):
+    columns = line.rstrip('\n').split('\t')
+    if len(columns) < 10:
+        print(line)
+        return None
+    return {
+        'document_id': columns[0],
+        'pub_year': columns[1],
+        'pub_month': columns[2],
+        'pub_day': columns[3] if not columns[3] == '-' else '',
+        'journal_name': columns[4] if len(columns[4]) > 1 else '',
+        'journal_abbrev': columns[5] if len(columns[5]) > 1 else '',
+        'volume': columns[6] if len(columns[6]) > 1 else '',
+        'issue': columns[7] if len(columns[7]) > 1 else '',
+        'article_title': columns[8] if len(columns[8]) > 1 else '',
+        'abstract': columns[9] if len(columns[9]) > 1 else '',
+    }
+
+
+def parse_documents(lines):
+    for line in lines:
+        document = parse_line(line)
+        if document:
+            yield document
 
 
 def load_file(filepath):
-    documents = []
     print('loading ' + filepath)
     with open(filepath, 'r') as infile:
-        for line in infile:
-            columns = line.split('\t')
-            if len(columns) < 10:
-                print(line)
-                continue
-            documents.append({
-                'document_id': columns[0],
-                'pub_year': columns[1],
-                'pub_month': columns[2],
-                'pub_day': columns[3] if not columns[3] == '-' else '',
-                'journal_name': columns[4] if len(columns[4]) > 1 else '',
-                'journal_abbrev': columns[5] if len(columns[5]) > 1 else '',
-                'volume': columns[6] if len(columns[6]) > 1 else '',
-                'issue': columns[7] if len(columns[7]) > 1 else '',
-                'article_title': columns[8] if len(columns[8]) > 1 else '',
-                'abstract': columns[9] if len(columns[9]) > 1 else '',
-            })
+        documents = list(parse_documents(infile))
     print(f'{len(documents)} documents loaded')
     return documents
 
 
-def get_file(remote_bucket, remote_filename):
-    print(f'Attempting to get file {remote_filename} from bucket {remote_bucket}')
-    try:
-        with open('/tmp/source.gz', 'wb') as dest:
-            gcp_client.download_fileobj(remote_bucket, remote_filename, dest)
-        print('file downloaded, attempting to extract to plaintext file')
-        with gzip.open('/tmp/source.gz', 'rb') as gzfile:
-            byte_contents = gzfile.read()
-            with open('/tmp/source.tsv', 'wb') as tsvfile:
-                count = tsvfile.write(byte_contents)
-        print('file created')
-        os.remove('/tmp/source.gz')
-        return '/tmp/source.tsv'
-    except botocore.exceptions.ClientError as error:
-        print("A ClientError happened")
-        print(error)
-        return None
-    except:
-        print("An error other than ClientError happened")
-        return None
+def open_remote_file(remote_bucket, remote_filename):
+    print(f'Attempting to stream file {remote_filename} from bucket {remote_bucket}')
+    response = gcp_client.get_object(Bucket=remote_bucket, Key=remote_filename)
+    stream = response['Body']
+    if remote_filename.endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    return io.TextIOWrapper(stream, encoding='utf-8')
 
 
-def process_file(local_filepath, is_delete=False):
+def new_report(is_delete):
+    if is_delete:
+        return {'delete': {'pubmed': 0, 'pmc': 0, 'doi': 0}}
+    return {'load_results': {}, 'sample_ids': []}
+
+
+def content_changed(doc, existing):
+    """Whether a parsed document is new, or differs from the stored one when fingerprinted with its stored aliases."""
+    return existing is None or existing.get('content_hash') != fingerprint(doc, existing.get('aliases'))
+
+
+def resolve_batch(pubmed_documents):
+    """
+    Looks up synonyms only for the documents that are new or changed, so unchanged documents cost no documentIds or
+    NCBI lookups. upsert_documents fingerprints the rest with their stored aliases, and skips them.
+    """
+    existing_documents = get_existing_fingerprints([doc['document_id'] for doc in pubmed_documents])
+    return get_synonyms([pmid_number(doc['document_id']) for doc in pubmed_documents
+                         if content_changed(doc, existing_documents.get(doc['document_id']))])
+
+
+def write_batch(pubmed_documents, synonyms, report):
+    """
+    Upserts one parsed batch; synonyms is the future returned by the resolve stage. Documents whose synonyms could not
+    be looked up are still written, and recorded as an error in the report.
+    """
+    synonyms, unresolved_ids = synonyms.result()
+    document_ids = [doc['document_id'] for doc in pubmed_documents]
+    if len(report['sample_ids']) < 5:
+        existing_ids = set(get_existing_documents(document_ids))
+        report['sample_ids'].extend([x for x in document_ids if x not in existing_ids][:5 - len(report['sample_ids'])])
+    print(f'got synonyms for {len(document_ids)} documents, upserting')
+    counts = upsert_documents(pubmed_documents, synonyms, unresolved_ids)
+    add_counts(report['load_results'], counts)
+    if counts['unresolved'] > 0:
+        report.setdefault('errors', []).append(
+            f"could not look up synonyms for {counts['unresolved']} documents; they were written without aliases "
+            f"and are looked up again on the next run")
+
+
+def delete_batch(id_list, report):
+    print(f'deleting existing documents ({len(id_list)})')
+    add_counts(report['delete'], delete_existing_documents(id_list))
+
+
+class LoadPipeline:
+    """
+    Overlaps the stages of a load. The caller streams and parses the files, up to resolve_workers batches look up
+    their synonyms (documentIds, then the NCBI ID converter) at the same time, and a single writer thread applies the
+    batches to Mongo in the order they were read, so a later update file still wins over an earlier one. At most
+    depth batches are in flight, which bounds memory. A batch that fails in either stage is recorded in the report of
+    the file it came from, and the load goes on. So are documents whose ID converter lookup gave up: write_batch still
+    writes them, without aliases, and the next run looks them up again.
+    """
+
+    def __init__(self, resolve_workers: int = 4, depth: int = 8):
+        self.depth = depth
+        self.writes = deque()
+        self.resolver = ThreadPoolExecutor(max_workers=resolve_workers, thread_name_prefix='load-resolve')
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='load-write')
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            resolve_workers=int(os.environ.get('LOAD_RESOLVE_WORKERS', 4)),
+            depth=int(os.environ.get('LOAD_PIPELINE_DEPTH', 8))
+        )
+
+    def submit(self, batch, report, is_delete=False):
+        if is_delete:
+            write = self.writer.submit(delete_batch, batch, report)
+        else:
+            write = self.writer.submit(write_batch, batch, self.resolver.submit(resolve_batch, batch), report)
+        self.writes.append((write, report))
+        while len(self.writes) > self.depth or (self.writes and self.writes[0][0].done()):
+            self.finish_oldest()
+
+    def finish_oldest(self):
+        write, report = self.writes.popleft()
+        try:
+            write.result()
+        except Exception as error:
+            print(f'batch failed: {type(error).__name__}: {error}')
+            report.setdefault('errors', []).append(f'{type(error).__name__}: {error}')
+
+    def drain(self):
+        while self.writes:
+            self.finish_oldest()
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            self.resolver.shutdown()
+            self.writer.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def queue_stream(pipeline, lines, report, is_delete=False, batch_size=None):
+    if not batch_size:
+        batch_size = int(os.environ.get('LOAD_BATCH_SIZE', 5000))
     if is_delete:
-        id_list = [x.strip() for x in open(local_filepath, 'r').readlines()]
-        if len(id_list) == 0:
-            return {'delete': 0}
-        print(f'deleting existing documents ({len(id_list)})')
-        return {'delete': delete_existing_documents(id_list)}
-    pubmed_documents = load_file(local_filepath)
-    print('file loaded')
+        batches = batched((x.strip() for x in lines if len(x.strip()) > 0), batch_size)
+    else:
+        batches = batched(parse_documents(lines), batch_size)
+    batch_count = 0
+    for batch in batches:
+        batch_count += 1
+        pipeline.submit(batch, report, is_delete)
+    print(f'{batch_count} batches queued')
+
+
+def process_stream(lines, is_delete=False, batch_size=None):
+    report = new_report(is_delete)
+    with LoadPipeline.from_environment() as pipeline:
+        queue_stream(pipeline, lines, report, is_delete, batch_size)
+    return report
+
+
+def process_file(local_filepath, is_delete=False):
+    with open(local_filepath, 'r') as infile:
+        results = process_stream(infile, is_delete)
     os.remove(local_filepath)
-    id_list = [doc['document_id'].split(':')[-1] for doc in pubmed_documents]
-    existing_ids = get_existing_documents(id_list)
-    new_ids = list(set(id_list) - set(existing_ids))
-    synonyms = get_synonyms(id_list)
-    print('got synonyms\nupserting documents')
-    upsert_results = upsert_documents(pubmed_documents, synonyms)
-    return {'load_results': upsert_results, 'sample_ids': new_ids[:5]}
+    return results
+
+
+def list_files(remote_bucket, prefix):
+    paginator = gcp_client.get_paginator('list_objects_v2')
+    keys = [item['Key'] for page in paginator.paginate(Bucket=remote_bucket, Prefix=prefix)
+            for item in page.get('Contents', []) if not item['Key'].endswith('/')]
+    return sorted(keys)
+
+
+def process_files(remote_bucket, filepaths, is_delete=False, batch_size=None):
+    """
+    Loads several bucket files in one pass through a shared LoadPipeline, in the given order, and reports per file.
+    A file that cannot be read or parsed is reported and skipped, as is each batch that fails to load; batches read
+    before the failure are still written. Rerunning the file is safe: unchanged documents are not rewritten, and
+    documents whose synonym lookup gave up have no content_hash, so they are looked up again.
+    """
+    start = time.perf_counter()
+    reports = {}
+    with LoadPipeline.from_environment() as pipeline:
+        for filepath in filepaths:
+            report = reports[filepath] = new_report(is_delete)
+            try:
+                with open_remote_file(remote_bucket, filepath) as lines:
+                    queue_stream(pipeline, lines, report, is_delete, batch_size)
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError, EOFError) as error:
+                print(f'could not read {filepath}: {error}')
+                report.setdefault('errors', []).append(f"could not read {filepath.split('/')[-1]}: {error}")
+            except Exception as error:
+                print(f'could not load {filepath}: {type(error).__name__}: {error}')
+                report.setdefault('errors', []).append(f"could not load {filepath.split('/')[-1]}: "
+                                                       f"{type(error).__name__}: {error}")
+    totals = {}
+    for report in reports.values():
+        add_counts(totals, {key: value for key, value in report.items() if key in ('load_results', 'delete')})
+    return {
+        'files': reports,
+        'totals': totals,
+        'failed': [filepath for filepath, report in reports.items() if 'errors' in report],
+        'seconds': round(time.perf_counter() - start, 1)
+    }
+
+
+def connect(source_info):
+    """Points the module at the database and bucket, reusing the clients of earlier files and warm invocations."""
+    global mongo_client
+    global gcp_client
+    global collection
+    global reference
+    if mongo_client is None:
+        mongo_client = MongoClient(os.environ['connection_string'])
+    credentials = (source_info['hmac_key_id'], source_info['hmac_secret'])
+    if credentials not in gcp_clients:
+        gcp_clients[credentials] = boto3.client(
+            's3',
+            region_name='auto',
+            endpoint_url='https://storage.googleapis.com',
+            aws_access_key_id=source_info['hmac_key_id'],
+            aws_secret_access_key=source_info['hmac_secret'],
+            config=Config(connect_timeout=5, retries={'max_attempts': 0})
+        )
+    gcp_client = gcp_clients[credentials]
+    db = mongo_client['test']
+    collection = db['documentMetadata']
+    reference = db['documentIds']
 
 
 def lambda_handler(event, context):
@@ -197,34 +430,43 @@ def lambda_handler(event, context):
         body = json.loads(event['body'])
     else:
         body = event
-    if os.environ and 'connection_string' in os.environ:
-        client = MongoClient(os.environ['connection_string'])
-    else:
+    if not os.environ or 'connection_string' not in os.environ:
         return 'Could not get database connection information', 500
     if 'source' not in body:
         return 'No source information provided', 400
     source_info = body['source']
+    connect(source_info)
+    is_delete = source_info.get('is_delete', False)
+    if 'filepaths' in source_info or 'prefix' in source_info:
+        filepaths = source_info['filepaths'] if 'filepaths' in source_info else \
+            list_files(source_info['bucket'], source_info['prefix'])
+        print(f"processing {len(filepaths)} files from {source_info['bucket']}")
+        return process_files(source_info['bucket'], filepaths, is_delete)
     print(source_info['bucket'], source_info['filepath'])
-    global gcp_client
-    global collection
-    global reference
-    print('connected to DocDB\nconnecting to GCP')
-    gcp_client = boto3.client(
-        's3',
-        region_name='auto',
-        endpoint_url='https://storage.googleapis.com',
-        aws_access_key_id=source_info['hmac_key_id'],
-        aws_secret_access_key=source_info['hmac_secret'],
-        config=Config(connect_timeout=5, retries={'max_attempts': 0})
-    )
-    db = client['test']
-    collection = db['documentMetadata']
-    reference = db['documentIds']
-    print('getting file')
-    local_filepath = get_file(source_info['bucket'], source_info['filepath'])
-    if not local_filepath:
-        if '/' in source_info['filepath']:
-            return {'result': f"could not get file {source_info['filepath'].split('/')[-1]}"}
-        return {'result': f"could not get file {source_info['filepath']}"}
+    print('streaming file')
+    try:
+        lines = open_remote_file(source_info['bucket'], source_info['filepath'])
+    except botocore.exceptions.ClientError as error:
+        print("A ClientError happened")
+        print(error)
+        return {'result': f"could not get file {source_info['filepath'].split('/')[-1]}"}
     print('processing file')
-    return process_file(source_info['bucket'], source_info['filepath'])
+    with lines:
+        return process_stream(lines, is_delete=is_delete)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load PubMed update files from the bucket in one pipelined run')
+    parser.add_argument('bucket')
+    parser.add_argument('filepaths', nargs='*', help='files to load, in order (default: everything under --prefix)')
+    parser.add_argument('--prefix', help='load every file under this prefix, in key order')
+    parser.add_argument('--delete', action='store_true', help='the files list document IDs to delete')
+    parser.add_argument('--batch-size', type=int)
+    args = parser.parse_args()
+    if not args.filepaths and args.prefix is None:
+        parser.error('give filepaths or --prefix')
+    if 'connection_string' not in os.environ:
+        parser.error('set connection_string')
+    connect({'hmac_key_id': os.environ['HMAC_KEY_ID'], 'hmac_secret': os.environ['HMAC_SECRET']})
+    files = args.filepaths or list_files(args.bucket, args.prefix)
+    print(json.dumps(process_files(args.bucket, files, args.delete, args.batch_size), indent=2))
@@ -0,0 +1,231 @@
+import argparse
+import datetime
+import gzip
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+from pymongo import MongoClient
+
+from batching import batched
+from formatting import METADATA_FIELDS, REFERENCE_PROJECTION, UPDATED_FIELD, format_document, utc_now
+from pub_ids import pmid_document_id, pmid_number
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('ndjson', 'parquet')
+EXTENSIONS = {'ndjson': '.ndjson.gz', 'parquet': '.parquet'}
+CANONICAL_RANGE = ('PMID:', 'PMID;')
+MANIFEST = 'manifest.json'
+SAMPLES_PER_SHARD = 100
+DEFAULT_OVERLAP_MINUTES = 10
+
+
+def parse_time(value: str) -> datetime.datetime:
+    """An ISO-8601 time as the naive UTC datetime Mongo stores."""
+    moment = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def format_time(moment: datetime.datetime) -> str:
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def export_query(canonical_only: bool = False, since: datetime.datetime = None, low: str = None,
+                 high: str = None) -> dict:
+    """Documents in [low, high) by document_id, only PMID documents if canonical_only, changed since `since`."""
+    if canonical_only:
+        low = max(low, CANONICAL_RANGE[0]) if low else CANONICAL_RANGE[0]
+        high = min(high, CANONICAL_RANGE[1]) if high else CANONICAL_RANGE[1]
+    query = {}
+    id_range = {}
+    if low is not None:
+        id_range['$gte'] = low
+    if high is not None:
+        id_range['$lt'] = high
+    if len(id_range) > 0:
+        query['document_id'] = id_range
+    if since is not None:
+        query[UPDATED_FIELD] = {'$gte': since}
+    return query
+
+
+def shard_ranges(collection, query: dict, shards: int) -> list[tuple]:
+    """Splits document_id into up to `shards` ranges of similar size, using quantiles of a random sample of IDs."""
+    if shards <= 1:
+        return [(None, None)]
+    pipeline = [{'$match': query}, {'$sample': {'size': shards * SAMPLES_PER_SHARD}},
+                {'$project': {'_id': 0, 'document_id': 1}}]
+    sample = sorted(set(doc['document_id'] for doc in collection.aggregate(pipeline)))
+    if len(sample) == 0:
+        return [(None, None)]
+    bounds = sorted(set(sample[len(sample) * index // shards] for index in range(1, shards)))
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def attach_aliases(reference, records: list[dict]):
+    """Fills in the aliases of PMID records from documentIds, for collections that have not been compacted yet."""
+    pmids = [pmid_number(record['document_id']) for record in records if len(record['aliases']) == 0]
+    if len(pmids) == 0:
+        return
+    aliases_dict = {}
+    for record in reference.find({'PM': {'$in': pmids}}, REFERENCE_PROJECTION):
+        aliases_dict[pmid_document_id(record['PM'])] = [record[key] for key in ('PMC', 'DOI') if record.get(key)]
+    for record in records:
+        if len(record['aliases']) == 0 and record['document_id'] in aliases_dict:
+            record['aliases'] = aliases_dict[record['document_id']]
+
+
+def export_record(document: dict) -> dict:
+    return {'document_id': document['document_id'], 'aliases': document.get('aliases', [])} | format_document(document)
+
+
+class PartWriter:
+    """
+    Writes a shard as numbered part files of about rows_per_file rows each, one batch at a time: gzip-compressed
+    NDJSON, or Parquet with one zstd-compressed row group per batch.
+    """
+
+    def __init__(self, directory: str, name: str, file_format: str, rows_per_file: int):
+        self.directory = directory
+        self.name = name
+        self.file_format = file_format
+        self.rows_per_file = rows_per_file
+        self.files = []
+        self._file = None
+        self._rows = 0
+
+    def write(self, records: list[dict]):
+        if self._file is None or self._rows >= self.rows_per_file:
+            self._open_part()
+        if self.file_format == 'parquet':
+            self._file.write_table(pyarrow.Table.from_pylist(records, schema=parquet_schema()))
+        else:
+            self._file.write(b''.join(orjson.dumps(record) + b'\n' for record in records))
+        self._rows += len(records)
+        self.files[-1]['rows'] = self._rows
+
+    def _open_part(self):
+        self.close()
+        path = os.path.join(self.directory, f'{self.name}-{len(self.files):04d}{EXTENSIONS[self.file_format]}')
+        if self.file_format == 'parquet':
+            self._file = pyarrow.parquet.ParquetWriter(path, parquet_schema(), compression='zstd')
+        else:
+            self._file = gzip.open(path, 'wb', compresslevel=6)
+        self._rows = 0
+        self.files.append({'file': os.path.basename(path), 'rows': 0})
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self.files[-1]['bytes'] = os.path.getsize(os.path.join(self.directory, self.files[-1]['file']))
+
+
+def parquet_schema():
+    return pyarrow.schema([('document_id', pyarrow.string()), ('aliases', pyarrow.list_(pyarrow.string()))] +
+                          [(field, pyarrow.string()) for field in METADATA_FIELDS])
+
+
+def export_shard(db, query: dict, name: str, directory: str, formats: tuple, canonical_only: bool,
+                 batch_size: int, rows_per_file: int) -> dict:
+    projection = {'_id': 0, 'document_id': 1, 'aliases': 1} | {field: 1 for field in METADATA_FIELDS}
+    writers = [PartWriter(directory, name, file_format, rows_per_file) for file_format in formats]
+    rows = 0
+    cursor = db['documentMetadata'].find(query, projection, no_cursor_timeout=True)
+    try:
+        for batch in batched(cursor.batch_size(batch_size), batch_size):
+            records = [export_record(document) for document in batch]
+            if canonical_only:
+                attach_aliases(db['documentIds'], records)
+            for writer in writers:
+                writer.write(records)
+            rows += len(records)
+    finally:
+        cursor.close()
+        for writer in writers:
+            writer.close()
+    print(f'{name}: {rows} documents exported')
+    return {'name': name, 'query': orjson.loads(orjson.dumps(query, default=format_time)), 'rows': rows,
+            'files': [part for writer in writers for part in writer.files]}
+
+
+def export(db, directory: str, formats: tuple = ('ndjson',), shards: int = 8, canonical_only: bool = False,
+           since: datetime.datetime = None, batch_size: int = 5000, rows_per_file: int = 1000000,
+           overlap_minutes: float = None) -> dict:
+    """
+    Exports documentMetadata into directory as sharded, compressed part files and a manifest.json listing them.
+    Shards cover document_id ranges and are exported in parallel; each holds one batch in memory per format.
+    Deleted documents are not carried: an incremental export only holds documents written since `since`.
+    """
+    started = utc_now()
+    os.makedirs(directory, exist_ok=True)
+    ranges = shard_ranges(db['documentMetadata'], export_query(canonical_only, since), shards)
+    with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix='export') as executor:
+        futures = [executor.submit(export_shard, db, export_query(canonical_only, since, low, high),
+                                   f'part-{index:04d}', directory, formats, canonical_only, batch_size, rows_per_file)
+                   for index, (low, high) in enumerate(ranges)]
+        shard_results = [future.result() for future in futures]
+    manifest = {
+        'started': format_time(started),
+        'finished': format_time(utc_now()),
+        'since': format_time(since) if since else None,
+        'overlap_minutes': overlap_minutes,
+        'includes_deletions': False,
+        'canonical_only': canonical_only,
+        'formats': list(formats),
+        'rows': sum(shard['rows'] for shard in shard_results),
+        'shards': shard_results
+    }
+    with open(os.path.join(directory, MANIFEST + '.tmp'), 'wb') as outfile:
+        outfile.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+    os.replace(os.path.join(directory, MANIFEST + '.tmp'), os.path.join(directory, MANIFEST))
+    return manifest
+
+
+def previous_start(directory: str, overlap_minutes: float = DEFAULT_OVERLAP_MINUTES) -> datetime.datetime:
+    """
+    The start of the export in directory, moved back by overlap_minutes. The loader stamps updated_at before its
+    bulk_write lands, so a document stamped shortly before that export started may have been written after the export
+    read past it.
+    """
+    with open(os.path.join(directory, MANIFEST), 'rb') as infile:
+        started = parse_time(orjson.loads(infile.read())['started'])
+    return started - datetime.timedelta(minutes=overlap_minutes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export documentMetadata as sharded, compressed NDJSON and/or Parquet files for bulk consumers')
+    parser.add_argument('directory')
+    parser.add_argument('--format', nargs='+', choices=FORMATS, default=['ndjson'], dest='formats')
+    parser.add_argument('--shards', type=int, default=8, help='document_id ranges exported in parallel')
+    parser.add_argument('--canonical-only', action='store_true',
+                        help='one record per article: only PMID documents, with their PMC and DOI aliases')
+    since_group = parser.add_mutually_exclusive_group()
+    since_group.add_argument('--since', type=parse_time, help='only documents loaded or changed since this time')
+    since_group.add_argument('--previous', help='only documents loaded or changed since the export in this directory')
+    parser.add_argument('--overlap-minutes', type=float, default=DEFAULT_OVERLAP_MINUTES,
+                        help='with --previous, start this many minutes before the previous export started')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--rows-per-file', type=int, default=1000000)
+    args = parser.parse_args()
+    if 'parquet' in args.formats and pyarrow is None:
+        sys.exit('--format parquet needs pyarrow (pip install -r requirements-export.txt)')
+    if os.environ and 'connection_string' in os.environ:
+        database = MongoClient(os.environ['connection_string'])['test']
+    else:
+        database = MongoClient()['local']
+    since = previous_start(args.previous, args.overlap_minutes) if args.previous else args.since
+    manifest = export(database, args.directory, tuple(args.formats), args.shards, args.canonical_only, since,
+                      args.batch_size, args.rows_per_file, args.overlap_minutes if args.previous else None)
+    print({key: value for key, value in manifest.items() if key != 'shards'})
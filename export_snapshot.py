@@ -0,0 +1,79 @@
+import argparse
+import os
+import time
+
+import orjson
+from pymongo import MongoClient
+
+from formatting import FRAGMENT_FIELD, METADATA_FIELDS, REFERENCE_PROJECTION, document_keys, render_fragment
+from pub_ids import document_id_keys, id_type, reference_keys
+from snapshot import SnapshotWriter, publication_key, reference_key
+
+SAMPLE_SIZE = 10
+
+
+def add_sample(samples, pub_id):
+    group = samples[id_type(pub_id)]
+    if len(group) < SAMPLE_SIZE:
+        group.append(pub_id)
+
+
+def export_publications(collection, writer, batch_size):
+    samples = {'pmid': [], 'pmc': [], 'doi': []}
+    projection = {'_id': 0, 'document_id': 1, 'aliases': 1, FRAGMENT_FIELD: 1} | {field: 1 for field in METADATA_FIELDS}
+    count = 0
+    cursor = collection.find({}, projection, no_cursor_timeout=True)
+    try:
+        for document in cursor.batch_size(batch_size):
+            pub_ids = document_keys(document)
+            value = bytes(document[FRAGMENT_FIELD]) if FRAGMENT_FIELD in document else render_fragment(document)
+            writer.add([publication_key(key) for key in document_id_keys(document)], value)
+            for pub_id in pub_ids:
+                add_sample(samples, pub_id)
+            count += 1
+            if count % 100000 == 0:
+                print(f'{count} publications exported')
+    finally:
+        cursor.close()
+    return count, samples['pmid'] + samples['pmc'] + samples['doi']
+
+
+def export_identifiers(reference, writer, batch_size):
+    count = 0
+    cursor = reference.find({}, REFERENCE_PROJECTION, no_cursor_timeout=True)
+    try:
+        for record in cursor.batch_size(batch_size):
+            record = {field: value for field, value in record.items() if value}
+            keys = reference_keys(record)
+            if len(keys) == 0:
+                continue
+            writer.add([reference_key(key) for key in keys], orjson.dumps(record))
+            count += 1
+            if count % 100000 == 0:
+                print(f'{count} identifier records exported')
+    finally:
+        cursor.close()
+    return count
+
+
+def export(db, path, batch_size=5000):
+    started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    with SnapshotWriter(path) as writer:
+        publications, sample_ids = export_publications(db['documentMetadata'], writer, batch_size)
+        identifiers = export_identifiers(db['documentIds'], writer, batch_size)
+        meta = {'created': started, 'publications': publications, 'identifiers': identifiers, 'sample_ids': sample_ids}
+        writer.close(meta)
+    return meta | {'keys': writer.key_count, 'bytes': os.path.getsize(path)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export documentMetadata and documentIds into a memory-mapped snapshot file for SNAPSHOT_PATH')
+    parser.add_argument('path')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+    if os.environ and 'connection_string' in os.environ:
+        database = MongoClient(os.environ['connection_string'])['test']
+    else:
+        database = MongoClient()['local']
+    print(export(database, args.path, args.batch_size))
@@ -0,0 +1,285 @@
+import datetime
+import hashlib
+import time
+
+import orjson
+from bson import Binary
+from pymongo import UpdateOne
+
+from pub_ids import KEYS_FIELD, identifier_key, key_pub_id, reference_keys
+
+METADATA_FIELDS = ('journal_name', 'journal_abbrev', 'article_title', 'volume', 'issue', 'pub_year', 'pub_month',
+                   'pub_day', 'abstract')
+REFERENCE_FIELDS = {'PMC': 'PMC', 'DOI': 'DOI', 'PMID': 'PM'}
+IDCONV_TYPES = {'PMC': 'pmcid', 'DOI': 'doi', 'PMID': 'pmid'}
+REFERENCE_PROJECTION = {'_id': 0, 'PM': 1, 'PMC': 1, 'DOI': 1}
+FRAGMENT_FIELD = 'json_fragment'
+UPDATED_FIELD = 'updated_at'
+
+
+def utc_now() -> datetime.datetime:
+    """The current time as the naive UTC datetime Mongo stores and returns, e.g. for UPDATED_FIELD."""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def parse_fields(value) -> tuple:
+    if value is None or len(value) == 0:
+        return METADATA_FIELDS
+    if isinstance(value, str):
+        value = value.split(',')
+    fields = [field.strip() for field in value]
+    unknown_fields = [field for field in fields if field not in METADATA_FIELDS]
+    if len(unknown_fields) > 0:
+        raise ValueError(f'Unknown fields: {",".join(unknown_fields)}')
+    return tuple(field for field in METADATA_FIELDS if field in fields)
+
+
+def parse_id_list(body):
+    pub_ids = body['pubids'] if isinstance(body, dict) and 'pubids' in body else body
+    if not isinstance(pub_ids, list) or not all(isinstance(pub_id, str) for pub_id in pub_ids):
+        raise ValueError('Expected a JSON list of IDs, or an object with a "pubids" list')
+    return pub_ids
+
+
+def format_document(document: dict, fields: tuple = METADATA_FIELDS) -> dict:
+    return {field: document[field] if field in document else '' for field in fields}
+
+
+def publication_query(keys: list) -> dict:
+    return {KEYS_FIELD: {'$in': keys}}
+
+
+def publication_projection(fields: tuple, fragment: bool = False) -> dict:
+    if fragment:
+        return {'_id': 0, 'document_id': 1, KEYS_FIELD: 1, FRAGMENT_FIELD: 1}
+    return {'_id': 0, 'document_id': 1, KEYS_FIELD: 1} | {field: 1 for field in fields}
+
+
+def render_fragment(document: dict) -> bytes:
+    return orjson.dumps(format_document(document))
+
+
+def fragment_value(document: dict) -> Binary:
+    return Binary(render_fragment(document))
+
+
+def has_fields(value, fields: tuple) -> bool:
+    return isinstance(value, bytes) or all(field in value for field in fields)
+
+
+def stored_value(document: dict, fields: tuple):
+    """Returns the stored fragment for full-field lookups (None if it has not been rendered yet), else a dict."""
+    if fields == METADATA_FIELDS:
+        return bytes(document[FRAGMENT_FIELD]) if FRAGMENT_FIELD in document else None
+    return format_document(document, fields)
+
+
+def select_fields(value, fields: tuple) -> dict:
+    document = orjson.loads(value) if isinstance(value, bytes) else value
+    return {field: document[field] for field in fields}
+
+
+def render_entry(pub_id: str, value) -> bytes:
+    return orjson.dumps(pub_id) + b':' + (value if isinstance(value, bytes) else orjson.dumps(value))
+
+
+def render_ndjson_line(pub_id: str, value) -> bytes:
+    return b'{' + render_entry(pub_id, value) + b'}\n'
+
+
+def render_publications(meta: dict, results: dict, not_found: list) -> bytes:
+    """Assembles the /publications response from cached or stored fragments without re-encoding them."""
+    entries = [render_entry(pub_id, value) for pub_id, value in results.items()]
+    entries.append(b'"not_found":' + orjson.dumps(not_found))
+    return b'{"_meta":' + orjson.dumps(meta) + b',"results":{' + b','.join(entries) + b'}}'
+
+
+def publications_etag(fields: tuple, results: dict, not_found) -> str:
+    """
+    A weak ETag over the result documents as stored (fragments follow each document's content), so it changes
+    exactly when a result would. It leaves out _meta and does not depend on the order results were found in.
+    """
+    digest = hashlib.blake2b(','.join(fields).encode('utf-8'), digest_size=16)
+    for pub_id in sorted(results):
+        value = results[pub_id]
+        digest.update(b'\0' + pub_id.encode('utf-8') + b'\0')
+        digest.update(value if isinstance(value, bytes) else orjson.dumps(value))
+    digest.update(orjson.dumps(sorted(not_found)))
+    return f'W/"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """The weak comparison If-None-Match calls for."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag.removeprefix('W/')
+    return any(candidate.strip().removeprefix('W/') == opaque_tag for candidate in if_none_match.split(','))
+
+
+def document_keys(document: dict) -> list[str]:
+    return [document['document_id']] + (document['aliases'] if 'aliases' in document else [])
+
+
+def sample_id_query(low, high) -> tuple[dict, dict]:
+    """A range of typed keys, so the id_keys index bounds the scan."""
+    return {KEYS_FIELD: {'$elemMatch': {'$gte': low, '$lt': high}}}, {'_id': 0, KEYS_FIELD: 1}
+
+
+def sample_values(documents, low, high, count: int) -> list[str]:
+    values = []
+    for document in documents:
+        values.extend(key_pub_id(key) for key in document[KEYS_FIELD]
+                      if isinstance(key, type(low)) and low <= key < high)
+    return values[:count]
+
+
+def meta_object(start_time: float, n_results: int, request_id: str) -> dict:
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M%SZ', time.gmtime()),
+        'n_results': n_results,
+        'request_id': request_id,
+        'processing_time_ms': int((time.perf_counter() - start_time) * 1000.0),
+    }
+
+
+def reference_query(requested: dict):
+    """One $in on the typed keys of documentIds, so every spelling and case of a requested ID finds its record."""
+    keys = (identifier_key(id_type, pub_id) for id_type, ids in requested.items() for pub_id in ids)
+    keys = list(dict.fromkeys(key for key in keys if key is not None))
+    return {KEYS_FIELD: {'$in': keys}} if len(keys) > 0 else None
+
+
+def collect_reference_records(requested: dict, records) -> tuple[dict, dict]:
+    """Matches documentIds records to the requested IDs by typed key. Results are keyed by the requested ID."""
+    requested_keys = {id_type: {} for id_type, ids in requested.items() if len(ids) > 0}
+    for id_type, pub_ids_by_key in requested_keys.items():
+        for pub_id in requested[id_type]:
+            pub_ids_by_key.setdefault(identifier_key(id_type, pub_id), []).append(pub_id)
+    results_dict = {id_type: {} for id_type in requested_keys}
+    unfound_ids = {id_type: set(requested[id_type]) for id_type in requested_keys}
+    for record in records:
+        for id_type, pub_ids_by_key in requested_keys.items():
+            value = record.get(REFERENCE_FIELDS[id_type])
+            if not value:
+                continue
+            for pub_id in pub_ids_by_key.get(identifier_key(id_type, value), ()):
+                unfound_ids[id_type].discard(pub_id)
+                _, synonyms = format_reference_record(id_type, record)
+                results_dict[id_type][format_request_id(IDCONV_TYPES[id_type], pub_id)] = synonyms
+    return results_dict, unfound_ids
+
+
+def merge_identifier_results(results_dict: dict, batch_results: dict) -> dict:
+    for key, value in batch_results.items():
+        if key == 'pending':
+            results_dict.setdefault(key, []).extend(value)
+        else:
+            results_dict.setdefault(key, {}).update(value)
+    return results_dict
+
+
+def prefix_id(prefix: str, value) -> str:
+    return prefix + value if value else ''
+
+
+def format_reference_record(id_type: str, record: dict) -> tuple[str, dict]:
+    if id_type == 'PMC':
+        return record['PMC'].replace('PMC', 'PMC:'), {
+            'PMID': prefix_id('PMID:', record.get('PM')),
+            'DOI': prefix_id('DOI:', record.get('DOI'))
+        }
+    elif id_type == 'DOI':
+        return 'DOI:' + record['DOI'], {
+            'PMID': prefix_id('PMID:', record.get('PM')),
+            'PMC': record.get('PMC', '').replace('PMC', 'PMC:')
+        }
+    return 'PMID:' + record['PM'], {
+        'PMC': record.get('PMC', '').replace('PMC', 'PMC:'),
+        'DOI': prefix_id('DOI:', record.get('DOI'))
+    }
+
+
+def format_identifier_record(id_type: str, record: dict) -> tuple[str, dict]:
+    if id_type.lower() == 'pmid':
+        key = 'PMID:' + record['pmid']
+        value = {
+            'PMC': record['pmcid'].replace('PMC', 'PMC:') if 'pmcid' in record else '',
+            'DOI': 'DOI:' + record['doi'] if 'doi' in record else ''
+        }
+    elif id_type.lower() == 'pmcid':
+        key = record['pmcid'].replace('PMC', 'PMC:')
+        value = {
+            'PMID': 'PMID:' + record['pmid'] if 'pmid' in record else '',
+            'DOI': 'DOI:' + record['doi'] if 'doi' in record else ''
+        }
+    else:
+        key = 'DOI:' + record['doi']
+        value = {
+            'PMC': record['pmcid'].replace('PMC', 'PMC:') if 'pmcid' in record else '',
+            'PMID': 'PMID:' + record['pmid'] if 'pmid' in record else '',
+        }
+    return key, value
+
+
+def requested_id(id_type: str, record: dict) -> str:
+    if id_type.lower() == 'pmid':
+        return record.get('pmid', '')
+    elif id_type.lower() == 'pmcid':
+        return record.get('pmcid', '')
+    return record.get('doi', '').lower()
+
+
+def format_request_id(id_type: str, pub_id: str) -> str:
+    if id_type.lower() == 'pmid':
+        return 'PMID:' + pub_id
+    elif id_type.lower() == 'pmcid':
+        return pub_id.replace('PMC', 'PMC:')
+    return 'DOI:' + pub_id
+
+
+def process_idconv_records(id_type: str, ids: list[str], records: list[dict], failed_ids: list[str]):
+    """
+    Formats the idconv records for ids. Returns the synonyms dict, the records worth saving to documentIds,
+    the IDs NCBI does not know (for the negative cache) and the IDs left pending because their lookup failed.
+    """
+    records = [record for record in records if 'status' not in record or record['status'] != 'error']
+    synonyms_dict = {}
+    for record in records:
+        key, value = format_identifier_record(id_type, record)
+        synonyms_dict[key] = value
+    resolved_ids = set(requested_id(id_type, record) for record in records)
+    failed_ids = set(failed_ids)
+    if id_type.lower() == 'doi':
+        unresolved_ids = [pub_id for pub_id in ids if pub_id.lower() not in resolved_ids]
+    else:
+        unresolved_ids = [pub_id for pub_id in ids if pub_id not in resolved_ids]
+    unknown_ids = [pub_id for pub_id in unresolved_ids if pub_id not in failed_ids]
+    pending_ids = [format_request_id(id_type, pub_id) for pub_id in ids if pub_id in failed_ids]
+    return synonyms_dict, records, unknown_ids, pending_ids
+
+
+def identifier_updates(records: list[dict]) -> list[UpdateOne]:
+    """
+    Upserts the NCBI records into documentIds. Only the fields NCBI returned are set, so a field it leaves out does not
+    blank one that is already stored; new records get empty strings for the missing fields.
+    """
+    ops_list = []
+    for record in records:
+        document = {field: record[key] for field, key in (('PM', 'pmid'), ('PMC', 'pmcid'), ('DOI', 'doi'))
+                    if record.get(key)}
+        if len(document) == 0:
+            continue
+        if 'PM' in document:
+            key_filter = {'PM': document['PM']}
+        elif 'PMC' in document:
+            key_filter = {'PMC': document['PMC']}
+        else:
+            key_filter = {'DOI': document['DOI']}
+        update = {'$set': document, '$addToSet': {KEYS_FIELD: {'$each': reference_keys(document)}}}
+        missing_fields = {field: '' for field in ('PM', 'PMC', 'DOI') if field not in document}
+        if len(missing_fields) > 0:
+            update['$setOnInsert'] = missing_fields
+        ops_list.append(UpdateOne(key_filter, update, upsert=True))
+    return ops_list
@@ -0,0 +1,88 @@
+import datetime
+import heapq
+import os
+import random
+import threading
+
+from pymongo import UpdateOne
+
+from formatting import utc_now
+
+
+class HotSet:
+    """
+    Tracks the most requested publication IDs so they can be preloaded into the result cache after a restart.
+
+    A sample_rate share of requests is counted in memory (at most max_tracked IDs; the least requested half is
+    dropped when that is exceeded). drain() hands the counts over for flushing to the accessLog collection as $inc
+    upserts, and top_query() reads back the most requested IDs seen within window_days. IDs loaded by a preload are
+    remembered, so stats() can report how many cache hits the preload accounts for.
+    """
+
+    def __init__(self, sample_rate: float = 0.1, max_tracked: int = 50000, window_days: float = 7):
+        self.sample_rate = sample_rate
+        self.max_tracked = max_tracked
+        self.window_days = window_days
+        self._counts = {}
+        self._preloaded = set()
+        self._lock = threading.Lock()
+        self.preloaded_bytes = 0
+        self.hits = 0
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            sample_rate=float(os.environ.get('HOT_SET_SAMPLE_RATE', 0.1)),
+            max_tracked=int(os.environ.get('HOT_SET_MAX_TRACKED', 50000)),
+            window_days=float(os.environ.get('HOT_SET_WINDOW_DAYS', 7))
+        )
+
+    def record(self, pub_ids):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return
+        with self._lock:
+            for pub_id in pub_ids:
+                self._counts[pub_id] = self._counts.get(pub_id, 0) + 1
+            if len(self._counts) > self.max_tracked:
+                top = heapq.nlargest(self.max_tracked // 2, self._counts.items(), key=lambda item: item[1])
+                self._counts = dict(top)
+
+    def drain(self) -> dict:
+        with self._lock:
+            counts = self._counts
+            self._counts = {}
+        return counts
+
+    def updates(self, counts: dict) -> list[UpdateOne]:
+        now = utc_now()
+        return [UpdateOne({'_id': pub_id}, {'$inc': {'count': count}, '$set': {'last_seen': now}}, upsert=True)
+                for pub_id, count in counts.items()]
+
+    def top_query(self) -> tuple[dict, dict, list]:
+        since = utc_now() - datetime.timedelta(days=self.window_days)
+        return {'last_seen': {'$gte': since}}, {'_id': 1}, [('count', -1)]
+
+    def mark_preloaded(self, pub_ids, size: int):
+        with self._lock:
+            self._preloaded.update(pub_ids)
+            self.preloaded_bytes += size
+
+    def count_hits(self, pub_ids):
+        if len(self._preloaded) == 0:
+            return 0
+        hits = sum(1 for pub_id in pub_ids if pub_id in self._preloaded)
+        with self._lock:
+            self.hits += hits
+        return hits
+
+    def stats(self, cache_stats: dict) -> dict:
+        lookups = cache_stats['hits'] + cache_stats['negative_hits'] + cache_stats['misses']
+        with self._lock:
+            return {
+                'preloaded': len(self._preloaded),
+                'preloaded_bytes': self.preloaded_bytes,
+                'tracked': len(self._counts),
+                'hits': self.hits,
+                'share_of_hits': self.hits / cache_stats['hits'] if cache_stats['hits'] > 0 else 0.0,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0
+            }
@@ -0,0 +1,267 @@
+import http.client
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from metrics import NCBI_REQUESTS, NCBI_SECONDS
+
+IDCONV_PATH = '/pmc/utils/idconv/v1.0/'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def environment_settings() -> dict:
+    api_key = os.environ.get('NCBI_API_KEY')
+    return {
+        'base_url': os.environ.get('IDCONV_URL', 'https://www.ncbi.nlm.nih.gov'),
+        'max_concurrency': int(os.environ.get('IDCONV_CONCURRENCY', 3)),
+        'requests_per_second': float(os.environ.get('IDCONV_REQUESTS_PER_SECOND', 10 if api_key else 3)),
+        'max_retries': int(os.environ.get('IDCONV_MAX_RETRIES', 3)),
+        'timeout': float(os.environ.get('IDCONV_TIMEOUT_SECONDS', 10)),
+        'email': os.environ.get('NCBI_EMAIL', 'edgargaticacu@gmail.com'),
+        'api_key': api_key,
+        'circuit_breaker': CircuitBreaker(
+            failure_threshold=int(os.environ.get('IDCONV_BREAKER_FAILURES', 5)),
+            slow_call_seconds=float(os.environ.get('IDCONV_BREAKER_SLOW_SECONDS', 5)),
+            reset_seconds=float(os.environ.get('IDCONV_BREAKER_RESET_SECONDS', 30))
+        )
+    }
+
+
+def request_path(ids: list[str], id_type: str, tool: str, email: str, api_key: str = None) -> str:
+    params = {'ids': ','.join(ids), 'format': 'json', 'versions': 'no', 'tool': tool, 'email': email}
+    if id_type:
+        params['idtype'] = id_type
+    if api_key:
+        params['api_key'] = api_key
+    return IDCONV_PATH + '?' + urllib.parse.urlencode(params, safe=',/:')
+
+
+def response_records(response_data: dict) -> list[dict]:
+    return response_data['records'] if 'records' in response_data else []
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread of a client; acquire() blocks until a request may be sent, or returns False
+    if that would take longer than its timeout.
+    """
+
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float = None) -> bool:
+        if self.interval == 0:
+            return True
+        give_up = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) * self.interval
+            if give_up is not None and now + wait > give_up:
+                return False
+            time.sleep(wait)
+
+
+class Deadline:
+    """Time budget shared by every idconv call made while serving one request."""
+
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() == 0
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing dependency. After failure_threshold consecutive failures (errors, or calls slower
+    than slow_call_seconds) the circuit opens and allow() returns False for reset_seconds. After that, one trial
+    call is let through: success closes the circuit again, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, slow_call_seconds: float = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                return 'half-open'
+            return 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_seconds or self.trial_in_progress:
+                return False
+            self.trial_in_progress = True
+            return True
+
+    def record(self, succeeded: bool, elapsed: float = 0.0):
+        with self._lock:
+            self.trial_in_progress = False
+            if succeeded and elapsed <= self.slow_call_seconds:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    logging.warning(f'idconv circuit opened after {self.failures} failed or slow calls')
+                self.opened_at = time.monotonic()
+
+
+class IdConvClient:
+    """
+    Client for the NCBI PMC ID converter (https://www.ncbi.nlm.nih.gov/pmc/tools/id-converter-api/).
+
+    Keep-alive connections are pooled and reused, ID lists are split into chunks that are sent concurrently
+    (at most max_concurrency at a time, and no faster than requests_per_second), and failed chunks are retried
+    with exponential backoff. Calls stop early when a request's Deadline runs out, and are skipped entirely
+    while the circuit breaker is open. base_url can point at a local stub server for testing.
+    """
+
+    def __init__(self, base_url: str = 'https://www.ncbi.nlm.nih.gov', chunk_size: int = 200,
+                 max_concurrency: int = 3, requests_per_second: float = 3, max_retries: int = 3,
+                 backoff_seconds: float = 0.5, timeout: float = 10, tool: str = 'documentmetadataapi',
+                 email: str = 'edgargaticacu@gmail.com', api_key: str = None,
+                 circuit_breaker: CircuitBreaker = None):
+        url = urllib.parse.urlsplit(base_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.tool = tool
+        self.email = email
+        self.api_key = api_key
+        self.rate_limiter = RateLimiter(requests_per_second, burst=max_concurrency)
+        self.circuit_breaker = circuit_breaker if circuit_breaker else CircuitBreaker()
+        self._connections = queue.LifoQueue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='idconv')
+
+    @classmethod
+    def from_environment(cls):
+        return cls(**environment_settings())
+
+    def convert(self, ids: list[str], id_type: str = None, deadline: Deadline = None) -> tuple[list[dict], list[str]]:
+        """
+        Returns the raw idconv records for ids, and the IDs that could not be looked up because their chunk failed
+        after every retry, the deadline ran out or the circuit was open. id_type ('pmid', 'pmcid' or 'doi') may be
+        omitted to let NCBI detect it.
+        """
+        chunks = [ids[i:i + self.chunk_size] for i in range(0, len(ids), self.chunk_size)]
+        records = []
+        unresolved = []
+        if len(chunks) == 1:
+            chunk_records = self._convert_chunk(chunks[0], id_type, deadline)
+            if chunk_records is None:
+                return [], list(chunks[0])
+            return chunk_records, []
+        futures = {self._executor.submit(self._convert_chunk, chunk, id_type, deadline): chunk for chunk in chunks}
+        done, not_done = wait(futures, timeout=deadline.remaining() if deadline else None)
+        for future in not_done:
+            future.cancel()
+            unresolved.extend(futures[future])
+        for future in done:
+            chunk_records = future.result()
+            if chunk_records is None:
+                unresolved.extend(futures[future])
+            else:
+                records.extend(chunk_records)
+        return records, unresolved
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+    def _convert_chunk(self, ids: list[str], id_type: str, deadline: Deadline = None):
+        path = request_path(ids, id_type, self.tool, self.email, self.api_key)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                delay = self.backoff_seconds * 2 ** (attempt - 1)
+                if deadline and deadline.remaining() <= delay:
+                    break
+                time.sleep(delay)
+            if deadline and deadline.expired():
+                break
+            if not self.rate_limiter.acquire(deadline.remaining() if deadline else None):
+                logging.debug('idconv rate limit wait exceeds the deadline, skipping request')
+                NCBI_REQUESTS.labels('rate_limited').inc()
+                break
+            if not self.circuit_breaker.allow():
+                logging.debug('idconv circuit open, skipping request')
+                NCBI_REQUESTS.labels('circuit_open').inc()
+                return None
+            timeout = min(self.timeout, deadline.remaining()) if deadline else self.timeout
+            connection = self._get_connection(timeout)
+            t = time.perf_counter()
+            try:
+                logging.debug('sending request to %s', path)
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response_text = response.read()
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                self.circuit_breaker.record(False)
+                NCBI_REQUESTS.labels('network_error').inc()
+                logging.warning(f'idconv request failed (attempt {attempt + 1}): {error}')
+                continue
+            elapsed = time.perf_counter() - t
+            NCBI_SECONDS.observe(elapsed)
+            NCBI_REQUESTS.labels('ok' if response.status == 200 else 'http_error').inc()
+            if response.will_close:
+                connection.close()
+            else:
+                self._connections.put(connection)
+            if response.status == 200:
+                self.circuit_breaker.record(True, elapsed)
+                return response_records(json.loads(response_text))
+            self.circuit_breaker.record(response.status not in RETRY_STATUSES, elapsed)
+            logging.warning(f'idconv returned status {response.status} (attempt {attempt + 1})')
+            if response.status not in RETRY_STATUSES:
+                break
+        logging.error(f'idconv lookup failed for {len(ids)} IDs')
+        return None
+
+    def _get_connection(self, timeout: float) -> http.client.HTTPConnection:
+        try:
+            connection = self._connections.get_nowait()
+            connection.timeout = timeout
+            if connection.sock:
+                connection.sock.settimeout(timeout)
+            return connection
+        except queue.Empty:
+            pass
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
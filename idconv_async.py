@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+from idconv import RETRY_STATUSES, CircuitBreaker, Deadline, environment_settings, request_path, response_records
+from metrics import NCBI_REQUESTS, NCBI_SECONDS
+
+
+class AsyncRateLimiter:
+    """asyncio counterpart of idconv.RateLimiter."""
+
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, timeout: float = None) -> bool:
+        if self.interval == 0:
+            return True
+        give_up = time.monotonic() + timeout if timeout is not None else None
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) * self.interval
+                if give_up is not None and now + wait > give_up:
+                    return False
+                await asyncio.sleep(wait)
+
+
+class AsyncIdConvClient:
+    """
+    asyncio counterpart of idconv.IdConvClient, built on a pooled httpx.AsyncClient. Chunks run as concurrent
+    tasks limited by max_concurrency, with the same rate limit, retries, Deadline and circuit breaker semantics.
+    """
+
+    def __init__(self, base_url: str = 'https://www.ncbi.nlm.nih.gov', chunk_size: int = 200,
+                 max_concurrency: int = 3, requests_per_second: float = 3, max_retries: int = 3,
+                 backoff_seconds: float = 0.5, timeout: float = 10, tool: str = 'documentmetadataapi',
+                 email: str = 'edgargaticacu@gmail.com', api_key: str = None,
+                 circuit_breaker: CircuitBreaker = None):
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.tool = tool
+        self.email = email
+        self.api_key = api_key
+        self.rate_limiter = AsyncRateLimiter(requests_per_second, burst=max_concurrency)
+        self.circuit_breaker = circuit_breaker if circuit_breaker else CircuitBreaker()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        )
+
+    @classmethod
+    def from_environment(cls):
+        return cls(**environment_settings())
+
+    async def convert(self, ids: list[str], id_type: str = None,
+                      deadline: Deadline = None) -> tuple[list[dict], list[str]]:
+        chunks = [ids[i:i + self.chunk_size] for i in range(0, len(ids), self.chunk_size)]
+        if len(chunks) == 0:
+            return [], []
+        tasks = {asyncio.create_task(self._convert_chunk(chunk, id_type, deadline)): chunk for chunk in chunks}
+        done, not_done = await asyncio.wait(tasks, timeout=deadline.remaining() if deadline else None)
+        records = []
+        unresolved = []
+        for task in not_done:
+            task.cancel()
+            unresolved.extend(tasks[task])
+        for task in done:
+            chunk_records = task.result()
+            if chunk_records is None:
+                unresolved.extend(tasks[task])
+            else:
+                records.extend(chunk_records)
+        return records, unresolved
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _convert_chunk(self, ids: list[str], id_type: str, deadline: Deadline = None):
+        path = request_path(ids, id_type, self.tool, self.email, self.api_key)
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                if attempt > 0:
+                    delay = self.backoff_seconds * 2 ** (attempt - 1)
+                    if deadline and deadline.remaining() <= delay:
+                        break
+                    await asyncio.sleep(delay)
+                if deadline and deadline.expired():
+                    break
+                if not await self.rate_limiter.acquire(deadline.remaining() if deadline else None):
+                    logging.debug('idconv rate limit wait exceeds the deadline, skipping request')
+                    NCBI_REQUESTS.labels('rate_limited').inc()
+                    break
+                if not self.circuit_breaker.allow():
+                    logging.debug('idconv circuit open, skipping request')
+                    NCBI_REQUESTS.labels('circuit_open').inc()
+                    return None
+                timeout = min(self.timeout, deadline.remaining()) if deadline else self.timeout
+                t = time.perf_counter()
+                try:
+                    logging.debug('sending request to %s', path)
+                    response = await self._client.get(path, timeout=timeout)
+                except httpx.HTTPError as error:
+                    self.circuit_breaker.record(False)
+                    NCBI_REQUESTS.labels('network_error').inc()
+                    logging.warning(f'idconv request failed (attempt {attempt + 1}): {error}')
+                    continue
+                elapsed = time.perf_counter() - t
+                NCBI_SECONDS.observe(elapsed)
+                NCBI_REQUESTS.labels('ok' if response.status_code == 200 else 'http_error').inc()
+                if response.status_code == 200:
+                    self.circuit_breaker.record(True, elapsed)
+                    return response_records(response.json())
+                self.circuit_breaker.record(response.status_code not in RETRY_STATUSES, elapsed)
+                logging.warning(f'idconv returned status {response.status_code} (attempt {attempt + 1})')
+                if response.status_code not in RETRY_STATUSES:
+                    break
+        logging.error(f'idconv lookup failed for {len(ids)} IDs')
+        return None
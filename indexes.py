@@ -0,0 +1,185 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+from formatting import (METADATA_FIELDS, REFERENCE_PROJECTION, UPDATED_FIELD, publication_projection,
+                        publication_query, reference_query, sample_id_query)
+from hot_set import HotSet
+from pub_ids import KEYS_FIELD, SAMPLE_KEY_RANGES, ids_by_key
+
+SAMPLE_IDS = ['PMID:1', 'PMC1', '10.1000/1']
+
+
+def required_indexes(hot_set_window_days: float = None) -> dict:
+    """The indexes every query shape in query_shapes() relies on, as {collection: [(keys, options)]}."""
+    if hot_set_window_days is None:
+        hot_set_window_days = float(os.environ.get('HOT_SET_WINDOW_DAYS', 7))
+    return {
+        'documentMetadata': [
+            ([('document_id', ASCENDING)], {'unique': True}),
+            ([(KEYS_FIELD, ASCENDING)], {}),
+            ([(UPDATED_FIELD, ASCENDING)], {'sparse': True}),
+        ],
+        'documentIds': [
+            ([(KEYS_FIELD, ASCENDING)], {}),
+            ([('PM', ASCENDING)], {}),
+            ([('PMC', ASCENDING)], {}),
+            ([('DOI', ASCENDING)], {}),
+        ],
+        'accessLog': [
+            ([('count', DESCENDING)], {}),
+            ([('last_seen', ASCENDING)], {'expireAfterSeconds': int(hot_set_window_days * 86400)}),
+        ],
+    }
+
+
+def query_shapes() -> list[dict]:
+    """
+    Every query shape the API, loader and checker send, with placeholder values. Offline maintenance scans
+    (backfill_fragments, export_snapshot, full runs of export_documents and the orphan pass of compact_aliases) read
+    whole collections by design and are left out; sweep_orphans is checked one page at a time.
+    """
+    shapes = [
+        {'name': 'publications', 'collection': 'documentMetadata', 'filter': publication_query(list(ids_by_key(SAMPLE_IDS))),
+         'projection': publication_projection(METADATA_FIELDS, fragment=True)},
+        {'name': 'publications by document_id', 'collection': 'documentMetadata',
+         'filter': {'document_id': {'$in': SAMPLE_IDS}}, 'projection': publication_projection(METADATA_FIELDS)},
+        {'name': 'identifiers', 'collection': 'documentIds',
+         'filter': reference_query({'PMC': ['PMC1'], 'DOI': ['10.1000/1'], 'PMID': ['1']}),
+         'projection': REFERENCE_PROJECTION},
+        {'name': 'loader synonyms', 'collection': 'documentIds', 'filter': {'PM': {'$in': ['1']}}},
+        {'name': 'loader fingerprints', 'collection': 'documentMetadata',
+         'filter': {'document_id': {'$in': SAMPLE_IDS}},
+         'projection': {'_id': 0, 'document_id': 1, 'content_hash': 1, 'aliases': 1}},
+        {'name': 'checker merge scan', 'collection': 'documentMetadata',
+         'filter': {'document_id': {'$regex': '^PMID:'}}, 'projection': {'_id': 0, 'document_id': 1},
+         'sort': {'document_id': 1}},
+        {'name': 'incremental export', 'collection': 'documentMetadata',
+         'filter': {UPDATED_FIELD: {'$gte': datetime.datetime(2000, 1, 1)}},
+         'projection': {'_id': 0, 'document_id': 1, 'aliases': 1} | {field: 1 for field in METADATA_FIELDS}},
+        {'name': 'delete alias keys', 'collection': 'documentIds', 'filter': {'PM': {'$in': ['1']}},
+         'projection': {'_id': 0, 'PMC': 1, 'DOI': 1}},
+        {'name': 'delete stored aliases', 'collection': 'documentMetadata',
+         'filter': {'document_id': {'$in': SAMPLE_IDS}}, 'projection': {'_id': 0, 'aliases': 1}},
+        {'name': 'delete documents and copies', 'collection': 'documentMetadata',
+         'filter': {'document_id': {'$in': SAMPLE_IDS}}, 'projection': {'_id': 1}},
+        {'name': 'orphan sweep page', 'collection': 'documentMetadata',
+         'filter': {'document_id': {'$gt': '', '$not': {'$regex': '^PMID'}}}, 'projection': {'_id': 0, 'document_id': 1},
+         'sort': {'document_id': 1}, 'limit': 1000},
+    ]
+    hot_query, hot_projection, hot_sort = HotSet.from_environment().top_query()
+    shapes.append({'name': 'hot set', 'collection': 'accessLog', 'filter': hot_query, 'projection': hot_projection,
+                   'sort': dict(hot_sort), 'limit': 100})
+    for name, low, high in SAMPLE_KEY_RANGES:
+        query, projection = sample_id_query(low, high)
+        shapes.append({'name': f'sample {name} ids', 'collection': 'documentMetadata', 'filter': query,
+                       'projection': projection, 'limit': 10})
+    return shapes
+
+
+def index_problems(index_information: dict, required: dict = None, missing_only: bool = False) -> list[str]:
+    """
+    Describes each required index that is missing, or that exists with different options, given
+    {collection: collection.index_information()}.
+    """
+    problems = []
+    for collection_name, indexes in (required or required_indexes()).items():
+        existing = {tuple(index['key']): index for index in index_information[collection_name].values()}
+        for keys, options in indexes:
+            index = existing.get(tuple(keys))
+            if index is None:
+                problems.append(f'{collection_name}: missing index on {keys}')
+                continue
+            if missing_only:
+                continue
+            for option, value in options.items():
+                if index.get(option) != value:
+                    problems.append(f'{collection_name}: index on {keys} has {option}={index.get(option)}, '
+                                    f'expected {value}')
+    return problems
+
+
+def index_information(db, required: dict = None) -> dict:
+    return {collection_name: db[collection_name].index_information()
+            for collection_name in (required or required_indexes())}
+
+
+def ensure_indexes(db, required: dict = None) -> tuple[list[str], list[str]]:
+    """
+    Creates the missing required indexes and returns their names, plus the problems with existing indexes,
+    which are reported rather than replaced.
+    """
+    required = required or required_indexes()
+    created = []
+    for collection_name, indexes in required.items():
+        existing = set(tuple(index['key']) for index in db[collection_name].index_information().values())
+        for keys, options in indexes:
+            if tuple(keys) not in existing:
+                created.append(f'{collection_name}: ' + db[collection_name].create_index(keys, **options))
+    return created, index_problems(index_information(db, required), required)
+
+
+def plan_stages(plan: dict):
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+def explain_shape(db, shape: dict) -> list[str]:
+    command = {'find': shape['collection'], 'filter': shape['filter']}
+    for option in ('projection', 'sort', 'limit'):
+        if option in shape:
+            command[option] = shape[option]
+    explanation = db.command('explain', command, verbosity='queryPlanner')
+    return [stage for stage in plan_stages(explanation['queryPlanner']['winningPlan']) if stage]
+
+
+def verify_query_plans(db) -> list[str]:
+    """Explains every query shape and returns the ones whose winning plan contains a COLLSCAN."""
+    failures = []
+    for shape in query_shapes():
+        stages = explain_shape(db, shape)
+        logging.info(f"{shape['name']}: {' <- '.join(stages)}")
+        if 'COLLSCAN' in stages:
+            failures.append(f"{shape['name']} ({shape['collection']}): COLLSCAN in {stages}")
+    return failures
+
+
+def require_indexes(index_information: dict):
+    """Raises RuntimeError when a required index is missing, so the service refuses to start without it."""
+    problems = index_problems(index_information, missing_only=True)
+    if len(problems) > 0:
+        raise RuntimeError('Required indexes are missing (run `python indexes.py ensure`): '
+                           + '; '.join(problems))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create and verify the indexes the API and loader depend on')
+    parser.add_argument('command', choices=['ensure', 'check', 'explain'], nargs='?', default='check',
+                        help='ensure: create missing indexes, then explain; check: report missing indexes, then '
+                             'explain; explain: only verify the query plans')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    if os.environ and 'connection_string' in os.environ:
+        database = MongoClient(os.environ['connection_string'])['test']
+    else:
+        database = MongoClient()['local']
+    errors = []
+    if args.command == 'ensure':
+        created, conflicts = ensure_indexes(database)
+        for name in created:
+            print(f'created {name}')
+        errors.extend(conflicts)
+    elif args.command == 'check':
+        errors.extend(index_problems(index_information(database)))
+    errors.extend(verify_query_plans(database))
+    for error in errors:
+        print(f'ERROR: {error}', file=sys.stderr)
+    sys.exit(1 if len(errors) > 0 else 0)
@@ -0,0 +1,342 @@
+"""
+Request handling shared by main:app (Flask and pymongo) and asgi:app (Starlette and Motor). Nothing here does I/O:
+each app runs the queries these functions and classes describe with its own driver and hands back what it reads.
+"""
+import logging
+import os
+
+import orjson
+
+from compression import encode_body
+from formatting import (METADATA_FIELDS, collect_reference_records, etag_matches, has_fields, meta_object,
+                        parse_fields, parse_id_list, process_idconv_records, publication_projection, publication_query,
+                        publications_etag, reference_query, render_fragment, render_ndjson_line, render_publications,
+                        select_fields, stored_value)
+from idconv import Deadline
+from metrics import CACHE_LOOKUPS, record_cache_lookups, record_ids, stage
+from pub_ids import KEYS_FIELD, id_key, ids_by_key, normalize_pub_id, split_identifiers
+
+PUBLICATION_CURSOR_BATCH_SIZE = int(os.environ.get('PUBLICATION_CURSOR_BATCH_SIZE', 500))
+DOCUMENT_ID_FALLBACK = os.environ.get('DOCUMENT_ID_FALLBACK', '0') != '0'
+
+
+class WarmupState:
+    """What / and /readyz report about the warm-up, and the backoff between failed attempts."""
+
+    def __init__(self):
+        self.sample_ids = []
+        self.error = None
+        self.delay = 1
+
+    def finished(self, sample_ids: list[str]):
+        self.sample_ids = sample_ids
+        self.error = None
+        logging.info(f'Warm-up finished with {len(sample_ids)} sample IDs')
+
+    def failed(self, error: Exception) -> float:
+        """Records the error and returns how many seconds to wait before retrying."""
+        self.error = str(error)
+        delay = self.delay
+        self.delay = min(delay * 2, 60)
+        logging.exception(f'Warm-up failed, retrying in {delay} seconds')
+        return delay
+
+
+class HotSetPreload:
+    """
+    Splits the most requested IDs into batches of HOT_SET_BATCH_SIZE for the warm-up to load into the result cache,
+    and stops once HOT_SET_MAX_MB of cache is used.
+    """
+
+    def __init__(self, hot_set, cache):
+        self.hot_set = hot_set
+        self.cache = cache
+        self.size = int(os.environ.get('HOT_SET_SIZE', 50000))
+        self.budget = float(os.environ.get('HOT_SET_MAX_MB', 128)) * 1024 * 1024
+        self.batch_size = int(os.environ.get('HOT_SET_BATCH_SIZE', 5000))
+        self._before = 0
+
+    def batches(self, pub_ids: list[str]):
+        start_bytes = self.cache.bytes
+        for start in range(0, len(pub_ids), self.batch_size):
+            self._before = self.cache.bytes
+            if self._before - start_bytes >= self.budget:
+                break
+            yield pub_ids[start:start + self.batch_size]
+        logging.info(f'Preloaded {self.hot_set.stats(self.cache.stats())["preloaded"]} of {len(pub_ids)} hot IDs '
+                     f'({(self.cache.bytes - start_bytes) // 1024} KiB)')
+
+    def loaded(self, results: dict):
+        self.hot_set.mark_preloaded(results.keys(), self.cache.bytes - self._before)
+
+
+def publication_cache_stats(cache, coalescer, hot_set) -> dict:
+    stats = cache.stats()
+    stats['coalescer'] = coalescer.stats()
+    if hot_set is not None:
+        stats['hot_set'] = hot_set.stats(stats)
+    return stats
+
+
+def local_publications(pub_ids: list[str], fields: tuple, route: str, cache, hot_set,
+                       snapshot) -> tuple[dict, list[str]]:
+    """The results held by the result cache, then by the snapshot, and the IDs left for Mongo."""
+    with stage(route, 'cache'):
+        cached, missing = cache.get_many(pub_ids, lambda value: has_fields(value, fields))
+        record_cache_lookups('publications', cached, missing)
+        results = {pub_id: value if fields == METADATA_FIELDS else select_fields(value, fields)
+                   for pub_id, value in cached.items() if value is not None}
+        if hot_set is not None:
+            CACHE_LOOKUPS.labels('hot_set', 'hit').inc(hot_set.count_hits(results.keys()))
+    if snapshot is not None and len(missing) > 0:
+        with stage(route, 'snapshot'):
+            found, missing = snapshot.publications(missing, fields)
+        results.update(found)
+    return results, missing
+
+
+class PublicationQuery:
+    """
+    The Mongo queries behind a publication lookup, and the matching of the documents they return to the requested
+    IDs. The caller runs each (filter, projection) from queries() in turn and passes every document to add(), which
+    returns the (pub_id, value) pairs it found and caches them; the IDs still missing at the end are cached as such.
+
+    The first query is one $in on id_keys. Documents without a stored fragment are read again in full and rendered.
+    IDs id_key() cannot parse are only found by document_id, and so are documents loaded before id_keys existed until
+    backfill_fragments.py has run; DOCUMENT_ID_FALLBACK turns the document_id lookup on for those.
+    """
+
+    def __init__(self, pub_ids: list[str], fields: tuple, cache):
+        self.fields = fields
+        self.all_fields = fields == METADATA_FIELDS
+        self.cache = cache
+        self.missing = set(pub_ids)
+        self.requested = ids_by_key(pub_ids)
+        self.found = set([])
+        self.unrendered = []
+        self._add = None
+
+    def queries(self):
+        if len(self.requested) > 0:
+            self._add = self._add_stored
+            yield publication_query(list(self.requested)), publication_projection(self.fields, fragment=self.all_fields)
+        if len(self.unrendered) > 0:
+            self._add = self._add_unrendered
+            yield {'document_id': {'$in': self.unrendered}}, publication_projection(self.fields)
+        fallback_ids = [pub_id for pub_id in self.missing - self.found
+                        if DOCUMENT_ID_FALLBACK or id_key(pub_id) is None]
+        if len(fallback_ids) > 0:
+            self._add = self._add_by_document_id
+            yield {'document_id': {'$in': fallback_ids}}, publication_projection(self.fields)
+        self.cache.put_missing(self.missing - self.found)
+
+    def add(self, document: dict) -> list[tuple]:
+        return self._add(document)
+
+    def _add_stored(self, document: dict) -> list[tuple]:
+        value = stored_value(document, self.fields)
+        if value is None:
+            self.unrendered.append(document['document_id'])
+            return []
+        return self._matches(document, value)
+
+    def _add_unrendered(self, document: dict) -> list[tuple]:
+        return self._matches(document, render_fragment(document))
+
+    def _add_by_document_id(self, document: dict) -> list[tuple]:
+        value = render_fragment(document) if self.all_fields else stored_value(document, self.fields)
+        self.cache.put_many({document['document_id']: value}, merge=not self.all_fields)
+        self.found.add(document['document_id'])
+        return [(document['document_id'], value)]
+
+    def _matches(self, document: dict, value) -> list[tuple]:
+        matches = []
+        for key in document.get(KEYS_FIELD, []):
+            for pub_id in self.requested.get(key, ()):
+                if pub_id not in self.found:
+                    self.cache.put_many({pub_id: value}, merge=not self.all_fields)
+                    self.found.add(pub_id)
+                    matches.append((pub_id, value))
+        return matches
+
+
+def ids_by_fields(keys: list[tuple]) -> dict:
+    """Groups the (fields, pub_id) keys of a coalesced batch into one ID list per field selection."""
+    grouped = {}
+    for fields, pub_id in keys:
+        grouped.setdefault(fields, []).append(pub_id)
+    return grouped
+
+
+def publication_args(args) -> tuple[list[str], tuple, str]:
+    """The normalized IDs, fields and request_id of GET /publications. Raises ValueError for a bad request."""
+    if 'pubids' not in args:
+        raise ValueError('Missing the pubids parameter')
+    if 'request_id' not in args:
+        raise ValueError('Missing the request_id parameter')
+    fields = parse_fields(args.get('fields'))
+    return [normalize_pub_id(pub_id) for pub_id in args['pubids'].split(',')], fields, args['request_id']
+
+
+def bulk_publication_args(body, args) -> tuple[list[str], tuple, str]:
+    """The IDs, fields and request_id of POST /publications, from the JSON body or the query string."""
+    pub_ids = parse_id_list(body)
+    request_id = body['request_id'] if isinstance(body, dict) and 'request_id' in body else args.get('request_id', '')
+    fields = parse_fields(body['fields'] if isinstance(body, dict) and 'fields' in body else args.get('fields'))
+    return pub_ids, fields, request_id
+
+
+def publication_response(start_time: float, route: str, pub_ids: list[str], fields: tuple, results: dict,
+                         request_id: str, hot_set, if_none_match: str,
+                         accept_encoding: str) -> tuple[int, bytes, dict]:
+    """The status, body and headers of GET /publications: 304 when If-None-Match matches the ETag."""
+    not_found = set(pub_ids) - set(results.keys())
+    record_ids(route, len(results), len(not_found))
+    if hot_set is not None:
+        hot_set.record(results.keys())
+    etag = publications_etag(fields, results, not_found)
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+    if etag_matches(if_none_match, etag):
+        return 304, b'', headers
+    meta = meta_object(start_time, len(results), request_id)
+    print(meta)
+    with stage(route, 'render'):
+        body = render_publications(meta, results, list(not_found))
+    with stage(route, 'compress'):
+        body, encoding = encode_body(body, accept_encoding)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return 200, body, headers
+
+
+class PublicationStream:
+    """
+    The NDJSON body of POST /publications. batches() hands out the requested IDs normalized, PUBLICATION_BATCH_SIZE
+    at a time; the app passes each result to add() as its cursor batch arrives and sends on the lines add() and
+    flush() return. end() returns the last line, with _meta and not_found.
+    """
+
+    def __init__(self, route: str, pub_ids: list[str], hot_set):
+        self.route = route
+        self.pub_ids = pub_ids
+        self.hot_set = hot_set
+        self.batch_size = int(os.environ.get('PUBLICATION_BATCH_SIZE', 1000))
+        self.n_results = 0
+        self.not_found = []
+        self._found_ids = set([])
+        self._lines = []
+
+    def batches(self):
+        for start in range(0, len(self.pub_ids), self.batch_size):
+            with stage(self.route, 'normalize'):
+                corrected_pub_ids = [normalize_pub_id(pub_id) for pub_id in self.pub_ids[start:start + self.batch_size]]
+            self._found_ids = set([])
+            yield corrected_pub_ids
+            if self.hot_set is not None:
+                self.hot_set.record(self._found_ids)
+            self.n_results += len(self._found_ids)
+            self.not_found.extend(pub_id for pub_id in dict.fromkeys(corrected_pub_ids)
+                                  if pub_id not in self._found_ids)
+
+    def add(self, pub_id: str, value) -> bytes:
+        """Buffers the line for pub_id; returns the buffered lines once there are PUBLICATION_CURSOR_BATCH_SIZE."""
+        self._found_ids.add(pub_id)
+        self._lines.append(render_ndjson_line(pub_id, value))
+        if len(self._lines) >= PUBLICATION_CURSOR_BATCH_SIZE:
+            return self.flush()
+        return b''
+
+    def flush(self) -> bytes:
+        lines = b''.join(self._lines)
+        self._lines = []
+        return lines
+
+    def end(self, start_time: float, request_id: str) -> bytes:
+        record_ids(self.route, self.n_results, len(self.not_found))
+        meta = meta_object(start_time, self.n_results, request_id)
+        print(meta)
+        return self.flush() + orjson.dumps({'_meta': meta, 'not_found': self.not_found}) + b'\n'
+
+
+def identifier_args(args) -> list[str]:
+    """The IDs of GET /identifiers. Raises ValueError when pubids is missing."""
+    if 'pubids' not in args:
+        raise ValueError('Missing the pubids parameter')
+    return args['pubids'].split(',')
+
+
+def identifier_batches(pub_ids: list[str]):
+    batch_size = int(os.environ.get('IDENTIFIER_BATCH_SIZE', 1000))
+    for start in range(0, len(pub_ids), batch_size):
+        yield pub_ids[start:start + batch_size]
+
+
+def ncbi_deadline() -> Deadline:
+    """The budget shared by all NCBI calls made while serving one /identifiers request."""
+    return Deadline(float(os.environ.get('NCBI_BUDGET_MS', 2000)) / 1000.0)
+
+
+class IdentifierLookup:
+    """
+    The steps of resolving one batch of /identifiers IDs: query documentIds (or the snapshot first) by typed key,
+    hand the IDs it does not hold to the NCBI fallback, and merge what comes back. The caller runs the queries.
+    """
+
+    def __init__(self, pub_ids: list[str], route: str):
+        self.route = route
+        logging.info(f"Total ids: {len(pub_ids)}")
+        with stage(route, 'normalize'):
+            self.requested = split_identifiers(pub_ids)
+        logging.info(f"PMC: {len(self.requested['PMC'])}\tDOI: {len(self.requested['DOI'])}\t"
+                     f"PMID: {len(self.requested['PMID'])}")
+        self.query = reference_query(self.requested)
+        self.results_dict = {}
+        self.pending = []
+
+    def snapshot_records(self, snapshot) -> tuple[list[dict], dict]:
+        """The records the snapshot holds, and the documentIds query for the rest (None if there is nothing left)."""
+        records, missing = snapshot.reference_records(self.requested)
+        return records, reference_query(missing)
+
+    def add_records(self, records) -> dict:
+        """Matches the documentIds records and returns the IDs still unfound, as {id_type: [ids]}."""
+        self.results_dict, unfound = collect_reference_records(self.requested, records)
+        for id_type, unfound_ids in unfound.items():
+            logging.info(f"{len(self.requested[id_type]) - len(unfound_ids)} {id_type} IDs found in DB")
+        return {id_type: list(unfound_ids) for id_type, unfound_ids in unfound.items() if len(unfound_ids) > 0}
+
+    def add_ncbi_results(self, id_type: str, synonyms_dict: dict, pending_ids: list[str]):
+        logging.info(f"Found an additional {len(synonyms_dict.keys())} {id_type} IDs")
+        self.results_dict[id_type].update(synonyms_dict)
+        self.pending.extend(pending_ids)
+
+    def results(self) -> dict:
+        if len(self.pending) > 0:
+            logging.info(f"{len(self.pending)} IDs left unresolved by the NCBI fallback")
+            self.results_dict['pending'] = self.pending
+        return self.results_dict
+
+
+def uncached_identifiers(cache, id_type: str, ids: list[str]) -> list[str]:
+    """The IDs that are not in the negative cache of IDs NCBI does not know."""
+    cached, ids = cache.get_many([(id_type, pub_id) for pub_id in ids])
+    record_cache_lookups('ncbi_unknown', cached, ids)
+    if len(cached) > 0:
+        logging.debug(f"Skipping {len(cached)} IDs previously unknown to NCBI")
+    return [pub_id for _, pub_id in ids]
+
+
+def ncbi_results(cache, id_type: str, ids: list[str], records: list[dict],
+                 failed_ids: list[str]) -> tuple[dict, list[dict], list[str]]:
+    """
+    Formats an ID converter response and caches the IDs NCBI does not know. Returns the synonyms dict, the records
+    to write back to documentIds and the IDs left pending.
+    """
+    synonyms_dict, records, unknown_ids, pending_ids = process_idconv_records(id_type, ids, records, failed_ids)
+    cache.put_missing([(id_type, pub_id) for pub_id in unknown_ids])
+    return synonyms_dict, records, pending_ids
+
+
+def log_saved_identifiers(count: int, result):
+    logging.info(f"Saved {count} NCBI identifier records "
+                 f"({result.upserted_count} new, {result.modified_count} updated)")
@@ -1,14 +1,28 @@
-import http.client
 import os
-import re
 import time
-import json
 import logging
-from functools import lru_cache
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from coalescer import BatchCoalescer
+from compression import choose_encoding, compress_stream
+from formatting import (IDCONV_TYPES, METADATA_FIELDS, REFERENCE_PROJECTION, identifier_updates,
+                        merge_identifier_results, parse_id_list, sample_id_query, sample_values)
+from hot_set import HotSet
+from indexes import index_information, require_indexes
+from idconv import Deadline, IdConvClient
+from lookups import (PUBLICATION_CURSOR_BATCH_SIZE, HotSetPreload, IdentifierLookup, PublicationQuery,
+                     PublicationStream, WarmupState, bulk_publication_args, identifier_args, identifier_batches,
+                     ids_by_fields, local_publications, log_saved_identifiers, ncbi_deadline, ncbi_results,
+                     publication_args, publication_cache_stats, publication_response, uncached_identifiers)
+from pub_ids import SAMPLE_KEY_RANGES
+from metrics import BATCH_IDS, REQUEST_SECONDS, exposition, record_identifier_ids, stage, timed_iteration
+from result_cache import publication_cache_from_environment, unknown_identifier_cache_from_environment
+from snapshot import snapshot_from_environment
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.pymongo import PymongoInstrumentor
 from opentelemetry import trace
@@ -46,14 +60,48 @@ else:
     db = client['local']
 collection = db['documentMetadata']
 reference = db['documentIds']
+publication_cache = publication_cache_from_environment()
+unknown_identifier_cache = unknown_identifier_cache_from_environment()
+idconv_client = IdConvClient.from_environment()
+writeback_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='identifier-writeback')
+snapshot = snapshot_from_environment()
+use_database = snapshot is None or os.environ.get('SNAPSHOT_MONGO_FALLBACK', '1') != '0'
+warmed_up = threading.Event()
+access_log = db['accessLog']
+hot_set = HotSet.from_environment() if use_database else None
+warmup_state = WarmupState()
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    if 'request_start' in g:
+        REQUEST_SECONDS.labels(request.endpoint or 'unknown', response.status_code).observe(
+            time.perf_counter() - g.request_start)
+    return response
 
 
 @app.route('/')
 def health_check():
-    ids = get_pm_ids(10)
-    ids.extend(get_pmc_ids(10))
-    ids.extend(get_other_ids(10))
-    return {'ids': ids}
+    if not warmed_up.wait(float(os.environ.get('WARMUP_WAIT_SECONDS', 5))):
+        return {'ids': []}, 503
+    return {'ids': list(warmup_state.sample_ids)}
+
+
+@app.route('/livez')
+def liveness():
+    return {'status': 'ok'}
+
+
+@app.route('/readyz')
+def readiness():
+    if not warmed_up.is_set():
+        return {'status': 'warming up', 'error': warmup_state.error}, 503
+    return {'status': 'ready'}
 
 
 @app.route('/version')
@@ -61,197 +109,259 @@ def get_version():
     return "0.1.0", 200
 
 
-@lru_cache()
-def get_pm_ids(count):
-    return [x['document_id'] for x in collection.find({'document_id': {'$regex': '^PMID'}}).limit(count)]
+@app.route('/cache')
+def cache_stats():
+    return publication_cache_stats(publication_cache, publication_coalescer, hot_set)
+
+
+@app.route('/metrics')
+def get_metrics():
+    body, content_type = exposition()
+    return Response(body, content_type=content_type)
+
+
+def collect_sample_ids(count: int = 10) -> list[str]:
+    if snapshot is not None:
+        return snapshot.meta['sample_ids']
+    ids = []
+    for _, low, high in SAMPLE_KEY_RANGES:
+        query, projection = sample_id_query(low, high)
+        ids.extend(sample_values(collection.find(query, projection).limit(count), low, high, count))
+    return ids
+
+
+def warm_up():
+    """
+    Opens the Mongo connection pool, collects the sample IDs served by / and loads their documents into the
+    cache, retrying with backoff until it succeeds. /readyz reports ready once this has finished.
+    """
+    while True:
+        try:
+            if use_database:
+                connections = int(os.environ.get('WARMUP_CONNECTIONS', 8))
+                with ThreadPoolExecutor(max_workers=connections) as executor:
+                    list(executor.map(lambda _: client.admin.command('ping'), range(connections)))
+            sample_ids = collect_sample_ids()
+            get_publications(sample_ids, route='warm_up')
+            if hot_set is not None:
+                preload_hot_set()
+            warmup_state.finished(sample_ids)
+            warmed_up.set()
+            return
+        except Exception as error:
+            time.sleep(warmup_state.failed(error))
+
+
+def preload_hot_set():
+    """Loads the most requested IDs into the result cache in large batches, until HOT_SET_MAX_MB is used."""
+    preload = HotSetPreload(hot_set, publication_cache)
+    if preload.size <= 0:
+        return
+    query, projection, sort = hot_set.top_query()
+    pub_ids = [document['_id'] for document in access_log.find(query, projection).sort(sort).limit(preload.size)]
+    for pub_ids_batch in preload.batches(pub_ids):
+        preload.loaded(get_publications(pub_ids_batch, route='preload', coalesce=False))
+
+
+def check_indexes():
+    """Refuses to start without the indexes in indexes.py. An unreachable database is left to the warm-up retries."""
+    try:
+        information = index_information(db)
+    except PyMongoError:
+        logging.exception('Could not check the indexes')
+        return
+    require_indexes(information)
+
+
+def flush_hot_set():
+    interval = float(os.environ.get('HOT_SET_FLUSH_SECONDS', 60))
+    while True:
+        time.sleep(interval)
+        counts = hot_set.drain()
+        if len(counts) == 0:
+            continue
+        try:
+            access_log.bulk_write(hot_set.updates(counts), ordered=False)
+        except Exception:
+            logging.exception(f'Could not record {len(counts)} sampled accesses')
+
+
+def query_publications(pub_ids: list[str], fields: tuple = METADATA_FIELDS):
+    """Yields (pub_id, value) pairs as the cursor batches of each PublicationQuery query arrive."""
+    lookup = PublicationQuery(pub_ids, fields, publication_cache)
+    for query, projection in lookup.queries():
+        for document in collection.find(query, projection).batch_size(PUBLICATION_CURSOR_BATCH_SIZE):
+            yield from lookup.add(document)
+
+
+def fetch_coalesced_publications(keys: list[tuple]) -> dict:
+    results = {}
+    for fields, pub_ids in ids_by_fields(keys).items():
+        for pub_id, document in query_publications(pub_ids, fields):
+            results[(fields, pub_id)] = document
+    return results
+
+
+publication_coalescer = BatchCoalescer(
+    fetch_coalesced_publications,
+    window_ms=float(os.environ.get('COALESCE_WINDOW_MS', 2)),
+    max_batch=int(os.environ.get('COALESCE_MAX_BATCH', 1000))
+)
 
 
-@lru_cache()
-def get_pmc_ids(count):
-    return [x['document_id'] for x in collection.find({'document_id': {'$regex': '^PMC'}}).limit(count)]
+def get_publications(pub_ids: list[str], fields: tuple = METADATA_FIELDS, route: str = 'publication_lookup',
+                     coalesce: bool = True) -> dict:
+    results, missing = local_publications(pub_ids, fields, route, publication_cache, hot_set, snapshot)
+    if len(missing) > 0 and use_database:
+        with stage(route, 'mongo'):
+            if coalesce:
+                fetched = publication_coalescer.get_many([(fields, pub_id) for pub_id in missing])
+                results.update((pub_id, document) for (_, pub_id), document in fetched.items())
+            else:
+                results.update(query_publications(missing, fields))
+    return results
 
 
-@lru_cache()
-def get_other_ids(count):
-    return [x['document_id'] for x in collection.find({'document_id': {'$not': {'$regex': '^PM'}}}).limit(count)]
+def iter_publications(pub_ids: list[str], fields: tuple, route: str):
+    """
+    Yields (pub_id, value) pairs as they are found: cached and snapshot results first, then Mongo documents as their
+    cursor batches arrive, bypassing the coalescer. The mongo stage times only the cursor iteration.
+    """
+    results, missing = local_publications(pub_ids, fields, route, publication_cache, hot_set, snapshot)
+    yield from results.items()
+    if len(missing) > 0 and use_database:
+        yield from timed_iteration(route, 'mongo', query_publications(missing, fields))
 
 
 @app.route('/publications')
 def publication_lookup():
     t = time.perf_counter()
-    args = request.args
-    pub_ids = args['pubids'].split(',')
-    corrected_pub_ids = []
-    for pub_id in pub_ids:
-        corrected_id = re.sub('PMC:', 'PMC', pub_id, flags=re.IGNORECASE)
-        corrected_id = re.sub('DOI:', '', corrected_id, flags=re.IGNORECASE).strip()
-        corrected_pub_ids.append(corrected_id)
-    documents = [x for x in collection.find({'document_id': {'$in': corrected_pub_ids}})]
-    results = {}
-    for document in documents:
-        results[document["document_id"]] = {
-            'journal_name': document['journal_name'] if 'journal_name' in document else '',
-            'journal_abbrev': document['journal_abbrev'] if 'journal_abbrev' in document else '',
-            'article_title': document['article_title'] if 'article_title' in document else '',
-            'volume': document['volume'] if 'volume' in document else '',
-            'issue': document['issue'] if 'issue' in document else '',
-            'pub_year': document['pub_year'] if 'pub_year' in document else '',
-            'pub_month': document['pub_month'] if 'pub_month' in document else '',
-            'pub_day': document['pub_day'] if 'pub_day' in document else '',
-            'abstract': document['abstract'] if 'abstract' in document else ''
-        }
-    not_found = set(corrected_pub_ids) - set(results.keys())
-    results['not_found'] = list(not_found)
-    meta_object = {
-        'timestamp': time.strftime('%Y-%m-%dT%H:%M%SZ', time.gmtime()),
-        'n_results': len(results) - 1,
-        'request_id': args['request_id'],
-        'processing_time_ms': int((time.perf_counter() - t) * 1000.0),
-        }
-    print(meta_object)
-    response_object = {'_meta': meta_object, 'results': results}
-    return response_object
+    route = 'publication_lookup'
+    with stage(route, 'normalize'):
+        try:
+            pub_ids, fields, request_id = publication_args(request.args)
+        except ValueError as error:
+            return {'error': str(error)}, 400
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    results = get_publications(pub_ids, fields, route)
+    status, body, headers = publication_response(t, route, pub_ids, fields, results, request_id, hot_set,
+                                                 request.headers.get('If-None-Match'),
+                                                 request.headers.get('Accept-Encoding'))
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+@app.route('/publications', methods=['POST'])
+def bulk_publication_lookup():
+    t = time.perf_counter()
+    route = 'bulk_publication_lookup'
+    body = request.get_json(silent=True)
+    try:
+        pub_ids, fields, request_id = bulk_publication_args(body, request.args)
+    except ValueError as error:
+        return {'error': str(error)}, 400
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    stream = PublicationStream(route, pub_ids, hot_set)
+
+    def generate():
+        for corrected_pub_ids in stream.batches():
+            for pub_id, value in iter_publications(corrected_pub_ids, fields, route):
+                lines = stream.add(pub_id, value)
+                if len(lines) > 0:
+                    yield lines
+            lines = stream.flush()
+            if len(lines) > 0:
+                yield lines
+        yield stream.end(t, request_id)
+
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(compress_stream(generate(), encoding)), mimetype='application/x-ndjson',
+                    headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
 
 
 @app.route('/identifiers')
 def id_lookup():
-    args = request.args
-    pub_ids = args['pubids'].split(',')
-    logging.info(f"Total ids: {len(pub_ids)}")
-    pmcids = [re.sub('PMC:', 'PMC', pub_id, flags=re.IGNORECASE) for pub_id in pub_ids if pub_id.upper().startswith('PMC')]
-    dois = [re.sub('DOI:', '', pub_id, flags=re.IGNORECASE).strip() for pub_id in pub_ids if pub_id.upper().startswith('DOI')]
-    pmids = [re.sub('PMID:', '', pub_id, flags=re.IGNORECASE) for pub_id in pub_ids if pub_id.upper().startswith('PMID')]
-    logging.info(f"PMC: {len(pmcids)}\tDOI: {len(dois)}\tPMID: {len(pmids)}")
+    route = 'id_lookup'
+    try:
+        pub_ids = identifier_args(request.args)
+    except ValueError as error:
+        return {'error': str(error)}, 400
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    results_dict = resolve_identifiers(pub_ids, ncbi_deadline(), route)
+    record_identifier_ids(route, len(pub_ids), results_dict)
+    with stage(route, 'render'):
+        return jsonify(results_dict)
+
+
+@app.route('/identifiers', methods=['POST'])
+def batch_id_lookup():
+    route = 'batch_id_lookup'
+    try:
+        pub_ids = parse_id_list(request.get_json(silent=True))
+    except ValueError as error:
+        return {'error': str(error)}, 400
+    BATCH_IDS.labels(route).observe(len(pub_ids))
+    deadline = ncbi_deadline()
     results_dict = {}
-    if len(pmcids) > 0:
-        pmc_dict = {}
-        found_ids = set([])
-        records = [rec for rec in reference.find({'PMC': {'$in': pmcids}})]
-        if len(records) > 0:
-            for record in records:
-                found_ids.add(record['PMC'])
-                pmc_dict[record['PMC'].replace('PMC', 'PMC:')] = {
-                    'PMID': 'PMID:' + record['PM'],
-                    'DOI': 'DOI:' + record['DOI']
-                }
-        unfound_ids = set(pmcids) - found_ids
-        logging.info(f"{len(found_ids)} PMC IDs found in DB")
-        if len(unfound_ids) > 0:
-            logging.debug(f"Checking PMC API for {len(unfound_ids)} PMC IDs")
-            additional_identifiers = lookup_identifiers('pmcid', list(unfound_ids))
-            logging.info(f"Found an additional {len(additional_identifiers.keys())} PMC IDs")
-            pmc_dict.update(additional_identifiers)
-        results_dict['PMC'] = pmc_dict
-    if len(dois) > 0:
-        doi_dict = {}
-        found_ids = set([])
-        records = [rec for rec in reference.find({'DOI': {'$in': dois}})]
-        if len(records) > 0:
-            for record in records:
-                found_ids.add(record['DOI'])
-                doi_dict['DOI:' + record['DOI']] = {
-                    'PMID': 'PMID:' + record['PM'],
-                    'PMC': record['PMC'].replace('PMC', 'PMC:')
-                }
-        unfound_ids = set(dois) - found_ids
-        logging.info(f"{len(found_ids)} DOIs found in DB")
-        if len(unfound_ids) > 0:
-            logging.debug(f"Checking PMC API for {len(unfound_ids)} DOI IDs")
-            additional_identifiers = lookup_identifiers('doi', list(unfound_ids))
-            logging.info(f"Found an additional {len(additional_identifiers.keys())} DOIs")
-            doi_dict.update(additional_identifiers)
-        results_dict['DOI'] = doi_dict
-    if len(pmids) > 0:
-        pmid_dict = {}
-        found_ids = set([])
-        records = [rec for rec in reference.find({'PM': {'$in': pmids}})]
-        if len(records) > 0:
-            for record in records:
-                found_ids.add(record['PM'])
-                pmid_dict['PMID:' + record['PM']] = {
-                    'PMC': record['PMC'].replace('PMC', 'PMC:'),
-                    'DOI': 'DOI:' + record['DOI']
-                }
-        unfound_ids = set(pmids) - found_ids
-        logging.info(f"{len(found_ids)} PMIDs found in DB")
-        if len(unfound_ids) > 0:
-            logging.debug(f"Checking PMC API for {len(unfound_ids)} PMIDs")
-            additional_identifiers = lookup_identifiers('pmid', list(unfound_ids))
-            logging.info(f"Found an additional {len(additional_identifiers.keys())} PMIDs")
-            pmid_dict.update(additional_identifiers)
-        results_dict['PMID'] = pmid_dict
-    return results_dict
-
-
-def lookup_identifiers(id_type: str, ids: list[str], sublist_size: int = 200) -> dict:
-    synonyms_dict = {}
-    start_index = sublist_size
-    end_index = len(ids)
-    extra = end_index % sublist_size
-    for cap in range(start_index, end_index, sublist_size):
-        connection = http.client.HTTPSConnection('www.ncbi.nlm.nih.gov')
-        id_sublist = ids[cap - sublist_size: cap]
-        request_string = f'/pmc/utils/idconv/v1.0/?ids={",".join(id_sublist)}&idtype={id_type}'
-        request_string += '&format=json&versions=no&tool=documentmetadataapi&email=edgargaticacu@gmail.com'
-        logging.debug('sending request to %s', request_string)
-        connection.request('GET', request_string)
-        response = connection.getresponse()
-        if response.status == 200:
-            response_text = response.read()
-            response_data = json.loads(response_text)
-            if 'records' in response_data:
-                for record in response_data['records']:
-                    if id_type.lower() == 'pmid':
-                        key = 'PMID:' + record['pmid']
-                        value = {
-                            'PMC': record['pmcid'].replace('PMC', 'PMC:') if 'pmcid' in record else '',
-                            'DOI': 'DOI:' + record['doi'] if 'doi' in record else ''
-                        }
-                    elif id_type.lower() == 'pmcid':
-                        key = record['pmcid'].replace('PMC', 'PMC:')
-                        value = {
-                            'PMID': 'PMID:' + record['pmid'] if 'pmid' in record else '',
-                            'DOI': 'DOI:' + record['doi'] if 'doi' in record else ''
-                        }
-                    else:
-                        key = 'DOI:' + record['doi']
-                        value = {
-                            'PMC': record['pmcid'].replace('PMC', 'PMC:') if 'pmcid' in record else '',
-                            'PMID': 'PMID:' + record['pmid'] if 'pmid' in record else '',
-                        }
-                    synonyms_dict[key] = value
-    id_sublist = ids[-extra:]
-    connection = http.client.HTTPSConnection('www.ncbi.nlm.nih.gov')
-    request_string = f'/pmc/utils/idconv/v1.0/?ids={",".join(id_sublist)}&idtype={id_type}'
-    request_string += '&format=json&versions=no&tool=documentmetadataapi&email=edgargaticacu@gmail.com'
-    logging.debug('sending request to %s', request_string)
-    connection.request('GET', request_string)
-    response = connection.getresponse()
-    if response.status == 200:
-        response_text = response.read()
-        response_data = json.loads(response_text)
-        if 'records' in response_data:
-            for record in response_data['records']:
-                if id_type.lower() == 'pmid':
-                    key = 'PMID:' + record['pmid']
-                    value = {
-                        'PMC': record['pmcid'].replace('PMC', 'PMC:') if 'pmcid' in record else '',
-                        'DOI': 'DOI:' + record['doi'] if 'doi' in record else ''
-                    }
-                elif id_type.lower() == 'pmcid':
-                    key = record['pmcid'].replace('PMC', 'PMC:')
-                    value = {
-                        'PMID': 'PMID:' + record['pmid'] if 'pmid' in record else '',
-                        'DOI': 'DOI:' + record['doi'] if 'doi' in record else ''
-                    }
-                else:
-                    key = 'DOI:' + record['doi']
-                    value = {
-                        'PMC': record['pmcid'].replace('PMC', 'PMC:') if 'pmcid' in record else '',
-                        'PMID': 'PMID:' + record['pmid'] if 'pmid' in record else '',
-                    }
-                synonyms_dict[key] = value
-    return synonyms_dict
+    for pub_ids_batch in identifier_batches(pub_ids):
+        merge_identifier_results(results_dict, resolve_identifiers(pub_ids_batch, deadline, route))
+    record_identifier_ids(route, len(pub_ids), results_dict)
+    with stage(route, 'render'):
+        return jsonify(results_dict)
+
+
+def resolve_identifiers(pub_ids: list[str], deadline: Deadline, route: str = 'id_lookup') -> dict:
+    lookup = IdentifierLookup(pub_ids, route)
+    if lookup.query is None:
+        return {}
+    with stage(route, 'mongo'):
+        unfound = lookup.add_records(find_reference_records(lookup))
+    for id_type, unfound_ids in unfound.items():
+        logging.debug(f"Checking PMC API for {len(unfound_ids)} {id_type} IDs")
+        with stage(route, 'ncbi'):
+            lookup.add_ncbi_results(id_type, *lookup_identifiers(IDCONV_TYPES[id_type], unfound_ids, deadline))
+    return lookup.results()
+
+
+def find_reference_records(lookup: IdentifierLookup):
+    if snapshot is None:
+        return reference.find(lookup.query, REFERENCE_PROJECTION)
+    records, query = lookup.snapshot_records(snapshot)
+    if use_database and query is not None:
+        records.extend(reference.find(query, REFERENCE_PROJECTION))
+    return records
+
+
+def save_identifiers(records: list[dict]):
+    ops_list = identifier_updates(records)
+    if len(ops_list) == 0:
+        return
+    try:
+        log_saved_identifiers(len(ops_list), reference.bulk_write(ops_list, ordered=False))
+    except Exception:
+        logging.exception('Could not save NCBI identifier records')
+
+
+def lookup_identifiers(id_type: str, ids: list[str], deadline: Deadline = None) -> tuple[dict, list[str]]:
+    ids = uncached_identifiers(unknown_identifier_cache, id_type, ids)
+    if len(ids) == 0:
+        return {}, []
+    records, failed_ids = idconv_client.convert(ids, id_type, deadline)
+    synonyms_dict, records, pending_ids = ncbi_results(unknown_identifier_cache, id_type, ids, records, failed_ids)
+    if len(records) > 0 and use_database:
+        writeback_executor.submit(save_identifiers, records)
+    return synonyms_dict, pending_ids
+
+
+if use_database and os.environ.get('REQUIRE_INDEXES', '1') != '0':
+    check_indexes()
+if os.environ.get('WARMUP_ON_START', '1') != '0':
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+if hot_set is not None:
+    threading.Thread(target=flush_hot_set, name='hot-set-flush', daemon=True).start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest,
+                               multiprocess, REGISTRY)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .075, .1, .15, .2, .3, .5, .75, 1, 2, 5, 10)
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+REQUEST_SECONDS = Histogram('dm_request_seconds', 'Request latency by route', ['route', 'status'],
+                            buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram('dm_stage_seconds', 'Time spent in each stage of a request', ['route', 'stage'],
+                          buckets=LATENCY_BUCKETS)
+BATCH_IDS = Histogram('dm_batch_ids', 'Number of IDs per request', ['route'], buckets=BATCH_BUCKETS)
+IDS = Counter('dm_ids', 'Requested IDs by outcome (found, not_found or pending)', ['route', 'outcome'])
+CACHE_LOOKUPS = Counter('dm_cache_lookups', 'Result cache lookups by result (hit, negative_hit or miss)',
+                        ['cache', 'result'])
+NCBI_REQUESTS = Counter('dm_ncbi_requests', 'NCBI ID converter HTTP requests by outcome', ['outcome'])
+NCBI_SECONDS = Histogram('dm_ncbi_request_seconds', 'NCBI ID converter HTTP request latency',
+                         buckets=LATENCY_BUCKETS)
+
+
+def stage(route: str, name: str):
+    """Context manager that records the time spent in a stage of a request."""
+    return STAGE_SECONDS.labels(route, name).time()
+
+
+def timed_iteration(route: str, name: str, iterable):
+    """Yields from iterable, recording as the stage only the time spent producing items, not consuming them."""
+    iterator = iter(iterable)
+    elapsed = 0.0
+    while True:
+        t = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.perf_counter() - t
+        yield item
+    STAGE_SECONDS.labels(route, name).observe(elapsed)
+
+
+async def timed_async_iteration(route: str, name: str, iterable):
+    """timed_iteration for an async iterable."""
+    iterator = iterable.__aiter__()
+    elapsed = 0.0
+    while True:
+        t = time.perf_counter()
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            break
+        finally:
+            elapsed += time.perf_counter() - t
+        yield item
+    STAGE_SECONDS.labels(route, name).observe(elapsed)
+
+
+def record_ids(route: str, found: int, not_found: int, pending: int = 0):
+    IDS.labels(route, 'found').inc(found)
+    IDS.labels(route, 'not_found').inc(not_found)
+    if pending > 0:
+        IDS.labels(route, 'pending').inc(pending)
+
+
+def record_identifier_ids(route: str, requested: int, results_dict: dict):
+    found = sum(len(synonyms) for id_type, synonyms in results_dict.items() if id_type != 'pending')
+    pending = len(results_dict['pending']) if 'pending' in results_dict else 0
+    record_ids(route, found, max(requested - found - pending, 0), pending)
+
+
+def record_cache_lookups(cache: str, found: dict, missing: list):
+    hits = sum(1 for value in found.values() if value is not None)
+    CACHE_LOOKUPS.labels(cache, 'hit').inc(hits)
+    CACHE_LOOKUPS.labels(cache, 'negative_hit').inc(len(found) - hits)
+    CACHE_LOOKUPS.labels(cache, 'miss').inc(len(missing))
+
+
+def exposition() -> tuple[bytes, str]:
+    """
+    Renders every metric in the Prometheus text format. When PROMETHEUS_MULTIPROC_DIR is set (gunicorn with
+    several workers), the values are read from the per-process files there, so each scrape covers all workers.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
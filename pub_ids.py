@@ -0,0 +1,97 @@
+import re
+
+KEYS_FIELD = 'id_keys'
+PMC_BASE = 1 << 40
+SAMPLE_KEY_RANGES = (('pmid', 0, PMC_BASE), ('pmc', PMC_BASE, 2 * PMC_BASE), ('doi', '10.', '10/'))
+
+PMC_PREFIX = re.compile('PMC:', re.IGNORECASE)
+DOI_PREFIX = re.compile('DOI:', re.IGNORECASE)
+PMID_PREFIX = re.compile('PMID:', re.IGNORECASE)
+TYPED_ID = re.compile(r'(?:(?P<pmid>PMID:?)|PMC:?)(?P<number>\d+)|(?P<doi>10\..+)', re.IGNORECASE)
+
+
+def normalize_pub_id(pub_id: str) -> str:
+    """The form results are keyed by: PMC:123 becomes PMC123 and a DOI: prefix is dropped."""
+    return DOI_PREFIX.sub('', PMC_PREFIX.sub('PMC', pub_id)).strip()
+
+
+def id_key(pub_id: str):
+    """
+    The typed key of a normalized ID, as stored in id_keys: the PMID number, PMC_BASE plus the PMC number, or the
+    case-folded DOI. None for anything else.
+    """
+    match = TYPED_ID.fullmatch(pub_id)
+    if match is None:
+        return None
+    if match.group('doi'):
+        return match.group('doi').casefold()
+    number = int(match.group('number'))
+    if number >= PMC_BASE:
+        return None
+    return number if match.group('pmid') else PMC_BASE + number
+
+
+def ids_by_key(pub_ids: list[str]) -> dict:
+    """Groups normalized IDs by typed key; spellings of the same ID share a key. Unparseable IDs are left out."""
+    requested = {}
+    for pub_id in pub_ids:
+        key = id_key(pub_id)
+        if key is not None:
+            requested.setdefault(key, []).append(pub_id)
+    return requested
+
+
+def key_pub_id(key) -> str:
+    if isinstance(key, str):
+        return key
+    return f'PMC{key - PMC_BASE}' if key >= PMC_BASE else f'PMID:{key}'
+
+
+def key_text(key) -> str:
+    """A string form of a typed key; the decimal PMID and PMC keys cannot collide with a DOI, which has a dot."""
+    return key if isinstance(key, str) else str(key)
+
+
+def document_id_keys(document: dict) -> list:
+    keys = (id_key(pub_id) for pub_id in [document['document_id']] + document.get('aliases', []))
+    return list(dict.fromkeys(key for key in keys if key is not None))
+
+
+def identifier_key(id_type: str, pub_id):
+    """The typed key of an ID as split_identifiers returns it and documentIds stores it: a PMID is a bare number."""
+    return id_key(f'PMID:{pub_id}' if id_type == 'PMID' else str(pub_id))
+
+
+def reference_keys(record: dict) -> list:
+    """The typed keys of a documentIds record's PM, PMC and DOI fields, as stored in its id_keys."""
+    keys = (identifier_key(id_type, record[field]) for id_type, field in (('PMID', 'PM'), ('PMC', 'PMC'), ('DOI', 'DOI'))
+            if record.get(field))
+    return list(dict.fromkeys(key for key in keys if key is not None))
+
+
+def id_type(pub_id: str) -> str:
+    prefix = pub_id[:4].upper()
+    if prefix == 'PMID':
+        return 'pmid'
+    return 'pmc' if prefix.startswith('PMC') else 'doi'
+
+
+def pmid_number(document_id: str) -> str:
+    return document_id.split(':')[-1]
+
+
+def pmid_document_id(pmid: str) -> str:
+    return 'PMID:' + pmid
+
+
+def split_identifiers(pub_ids: list[str]) -> dict:
+    requested = {'PMC': [], 'DOI': [], 'PMID': []}
+    for pub_id in pub_ids:
+        prefix = pub_id[:4].upper()
+        if prefix.startswith('PMC'):
+            requested['PMC'].append(PMC_PREFIX.sub('PMC', pub_id))
+        elif prefix.startswith('DOI'):
+            requested['DOI'].append(DOI_PREFIX.sub('', pub_id).strip())
+        elif prefix == 'PMID':
+            requested['PMID'].append(PMID_PREFIX.sub('', pub_id))
+    return requested
@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_size(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """
+    Bounded, thread-safe LRU cache with per-entry expiry.
+
+    A value of None is stored as a negative result (the key is known not to exist) and expires after
+    negative_ttl seconds instead of ttl. Entries are evicted least-recently-used first whenever either
+    max_entries or max_bytes (an estimate of the memory held by cached values) is exceeded.
+    """
+
+    def __init__(self, max_entries: int = 100000, max_bytes: int = 256 * 1024 * 1024,
+                 ttl: float = 3600, negative_ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self.get_many([key])[0]
+
+    def get_many(self, keys, is_usable=None) -> tuple[dict, list]:
+        """
+        Returns a dict of the cached entries (negative entries map to None) and a list of the keys
+        that were not in the cache, in request order and without duplicates. Cached values for which
+        is_usable(value) is False are reported as misses but are left in the cache.
+        """
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] <= now:
+                    self._remove(key)
+                    self.expirations += 1
+                    entry = None
+                if entry is None or (entry[2] is not None and is_usable and not is_usable(entry[2])):
+                    self.misses += 1
+                    missing.append(key)
+                    continue
+                self._entries.move_to_end(key)
+                if entry[2] is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                found[key] = entry[2]
+        return found, missing
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, values: dict, merge: bool = False):
+        """When merge is True, dict values are merged over any unexpired dict already cached for the key."""
+        now = time.monotonic()
+        with self._lock:
+            for key, value in values.items():
+                if merge and isinstance(value, dict) and key in self._entries:
+                    entry = self._entries[key]
+                    if entry[0] > now and isinstance(entry[2], dict):
+                        value = entry[2] | value
+                if key in self._entries:
+                    self._remove(key)
+                size = estimate_size(key) + estimate_size(value)
+                if size > self.max_bytes:
+                    continue
+                expires = now + (self.negative_ttl if value is None else self.ttl)
+                self._entries[key] = (expires, size, value)
+                self.bytes += size
+            self._evict()
+
+    def put_missing(self, keys):
+        self.put_many({key: None for key in keys})
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': (self.hits + self.negative_hits) / lookups if lookups > 0 else 0.0
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[1]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+
+def publication_cache_from_environment() -> ResultCache:
+    return ResultCache(
+        max_entries=int(os.environ.get('CACHE_MAX_ENTRIES', 100000)),
+        max_bytes=int(os.environ.get('CACHE_MAX_MB', 256)) * 1024 * 1024,
+        ttl=float(os.environ.get('CACHE_TTL_SECONDS', 3600)),
+        negative_ttl=float(os.environ.get('CACHE_NEGATIVE_TTL_SECONDS', 300))
+    )
+
+
+def unknown_identifier_cache_from_environment() -> ResultCache:
+    return ResultCache(
+        max_entries=int(os.environ.get('NCBI_NEGATIVE_CACHE_MAX_ENTRIES', 100000)),
+        negative_ttl=float(os.environ.get('NCBI_NEGATIVE_TTL_SECONDS', 86400))
+    )
@@ -0,0 +1,157 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+import orjson
+
+from formatting import METADATA_FIELDS, select_fields
+from pub_ids import id_key, identifier_key, key_text
+
+MAGIC = b'DMSNAP03'
+HEADER = struct.Struct('<8sQQQQ')
+SLOT = struct.Struct('<QQQII')
+LOAD_FACTOR = 0.7
+PUBLICATION_PREFIX = 'publication|'
+REFERENCE_PREFIX = 'reference|'
+
+
+def key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def publication_key(key) -> str:
+    """Publications are stored under their typed keys (see pub_ids), so every spelling of an ID finds them."""
+    return PUBLICATION_PREFIX + key_text(key)
+
+
+def reference_key(key) -> str:
+    """documentIds records are stored under the typed keys of their PM, PMC and DOI fields, like publications."""
+    return REFERENCE_PREFIX + key_text(key)
+
+
+class SnapshotWriter:
+    """
+    Writes a snapshot file: the values back to back, each followed by the keys that point at it, then an
+    open-addressing hash table of fixed-size slots (hash, key offset, value offset, key length, value length)
+    and a JSON metadata object. The table is built from a temporary slot file so memory use does not grow with
+    the number of keys. The snapshot is written next to path and renamed into place by close().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path + '.tmp', 'w+b')
+        self._file.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+        self._slots = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self.key_count = 0
+
+    def add(self, keys: list[str], value: bytes):
+        value_offset = self._file.tell()
+        self._file.write(value)
+        for key in dict.fromkeys(keys):
+            key = key.encode('utf-8')
+            key_offset = self._file.tell()
+            self._file.write(key)
+            self._slots.write(SLOT.pack(key_hash(key), key_offset, value_offset, len(key), len(value)))
+            self.key_count += 1
+
+    def close(self, meta: dict = None):
+        slot_count = max(int(self.key_count / LOAD_FACTOR), 1)
+        table_offset = self._file.tell()
+        self._file.truncate(table_offset + slot_count * SLOT.size)
+        self._file.seek(0, os.SEEK_END)
+        meta_bytes = orjson.dumps((meta or {}) | {'keys': self.key_count})
+        meta_offset = self._file.tell()
+        self._file.write(meta_bytes)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, slot_count, table_offset, meta_offset, len(meta_bytes)))
+        self._file.flush()
+        with mmap.mmap(self._file.fileno(), 0) as table:
+            self._slots.seek(0)
+            while True:
+                chunk = self._slots.read(SLOT.size * 65536)
+                if not chunk:
+                    break
+                for slot in SLOT.iter_unpack(chunk):
+                    index = slot[0] % slot_count
+                    while struct.unpack_from('<Q', table, table_offset + index * SLOT.size + 8)[0] != 0:
+                        index = (index + 1) % slot_count
+                    SLOT.pack_into(table, table_offset + index * SLOT.size, *slot)
+            table.flush()
+        self._slots.close()
+        self._file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            return
+        self._slots.close()
+        self._file.close()
+        os.remove(self.path + '.tmp')
+
+
+class SnapshotReader:
+    """
+    Read-only view of a snapshot file. The file is memory-mapped, so lookups are a hash and one or two slot reads
+    served from the OS page cache, and every worker process on the host shares the same pages.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slot_count, self.table_offset, meta_offset, meta_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a document metadata snapshot in the current format; re-export it')
+        self.meta = orjson.loads(self._map[meta_offset:meta_offset + meta_length])
+
+    def get(self, key: str):
+        key = key.encode('utf-8')
+        hash_value = key_hash(key)
+        index = hash_value % self.slot_count
+        while True:
+            slot_hash, key_offset, value_offset, key_length, value_length = SLOT.unpack_from(
+                self._map, self.table_offset + index * SLOT.size)
+            if key_offset == 0:
+                return None
+            if slot_hash == hash_value and self._map[key_offset:key_offset + key_length] == key:
+                return self._map[value_offset:value_offset + value_length]
+            index = (index + 1) % self.slot_count
+
+    def publications(self, pub_ids: list[str], fields: tuple = METADATA_FIELDS) -> tuple[dict, list[str]]:
+        results = {}
+        missing = []
+        for pub_id in pub_ids:
+            key = id_key(pub_id)
+            value = self.get(publication_key(key)) if key is not None else None
+            if value is None:
+                missing.append(pub_id)
+            else:
+                results[pub_id] = value if fields == METADATA_FIELDS else select_fields(value, fields)
+        return results, missing
+
+    def reference_records(self, requested: dict) -> tuple[list[dict], dict]:
+        records = []
+        missing = {}
+        for id_type, ids in requested.items():
+            missing[id_type] = []
+            for pub_id in ids:
+                key = identifier_key(id_type, pub_id)
+                value = self.get(reference_key(key)) if key is not None else None
+                if value is None:
+                    missing[id_type].append(pub_id)
+                else:
+                    records.append(orjson.loads(value))
+        return records, missing
+
+    def close(self):
+        self._map.close()
+
+
+def snapshot_from_environment():
+    path = os.environ.get('SNAPSHOT_PATH')
+    return SnapshotReader(path) if path else None
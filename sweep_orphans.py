@@ -0,0 +1,84 @@
+import argparse
+import os
+
+from pymongo import MongoClient
+
+from batching import add_counts, delete_keys
+from formatting import REFERENCE_PROJECTION, reference_query
+from pub_ids import id_type, pmid_document_id
+
+
+def find_owners(reference, copy_ids):
+    """Maps each PMC or DOI key to the PMID document that documentIds assigns it to."""
+    requested = {'PMC': [x for x in copy_ids if id_type(x) == 'pmc'],
+                 'DOI': [x for x in copy_ids if id_type(x) == 'doi']}
+    copy_set = set(copy_ids)
+    owners = {}
+    for record in reference.find(reference_query(requested), REFERENCE_PROJECTION):
+        for field in ('PMC', 'DOI'):
+            if field in record and record[field] in copy_set and record.get('PM'):
+                owners[record[field]] = pmid_document_id(record['PM'])
+    return owners
+
+
+def sweep_batch(collection, reference, copy_ids, chunk_size, dry_run):
+    owners = find_owners(reference, copy_ids)
+    existing_ids = set(doc['document_id'] for doc in collection.find(
+        {'document_id': {'$in': list(set(owners.values()))}}, {'_id': 0, 'document_id': 1}))
+    orphans = {'pmc': [], 'doi': []}
+    for copy_id in copy_ids:
+        if copy_id in owners and owners[copy_id] not in existing_ids:
+            orphans[id_type(copy_id)].append(copy_id)
+    counts = {
+        'copies': len(copy_ids),
+        'unresolved': sum(1 for copy_id in copy_ids if copy_id not in owners),
+        'orphans': {key_type: len(keys) for key_type, keys in orphans.items()},
+        'deleted': {'pmc': 0, 'doi': 0}
+    }
+    if not dry_run:
+        for key_type, keys in orphans.items():
+            counts['deleted'][key_type] = delete_keys(collection, keys, chunk_size)
+    return counts
+
+
+def copy_id_pages(collection, batch_size):
+    """
+    Yields the PMC and DOI copy IDs in document_id order, batch_size at a time. Each page is its own query resuming
+    after the last ID of the one before, so memory stays at one page and deletes do not disturb the scan.
+    """
+    last_id = ''
+    while True:
+        page = [doc['document_id'] for doc in collection.find(
+            {'document_id': {'$gt': last_id, '$not': {'$regex': '^PMID'}}}, {'_id': 0, 'document_id': 1}
+        ).sort('document_id', 1).limit(batch_size)]
+        if len(page) == 0:
+            return
+        yield page
+        last_id = page[-1]
+
+
+def sweep(db, batch_size=1000, dry_run=False):
+    """
+    Purges PMC and DOI copies whose PMID document no longer exists. Copies whose PMID document still exists are left
+    for compact_aliases.py, and copies documentIds cannot place are only counted.
+    """
+    collection = db['documentMetadata']
+    reference = db['documentIds']
+    totals = {'copies': 0, 'unresolved': 0, 'orphans': {'pmc': 0, 'doi': 0}, 'deleted': {'pmc': 0, 'doi': 0}}
+    for batch in copy_id_pages(collection, batch_size):
+        add_counts(totals, sweep_batch(collection, reference, batch, batch_size, dry_run))
+        print(totals)
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Delete PMC and DOI copies in documentMetadata whose PMID document has been deleted')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true', help='report the orphans without deleting them')
+    args = parser.parse_args()
+    if os.environ and 'connection_string' in os.environ:
+        database = MongoClient(os.environ['connection_string'])['test']
+    else:
+        database = MongoClient()['local']
+    print(sweep(database, args.batch_size, args.dry_run))
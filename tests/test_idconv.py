@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from idconv import CircuitBreaker, Deadline, IdConvClient, RateLimiter
+
+
+class StubIdConvHandler(BaseHTTPRequestHandler):
+    """
+    Answers idconv requests like NCBI, like benchmark.FakeIdConvHandler. Each test gets its own subclass: statuses
+    is the queue of HTTP statuses to answer with before falling back to 200, and requests records every query.
+    """
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    statuses = []
+    requests = []
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        self.requests.append(query)
+        time.sleep(self.latency)
+        status = self.statuses.pop(0) if self.statuses else 200
+        records = [{'pmid': pub_id, 'pmcid': 'PMC' + pub_id, 'doi': f'10.9999/stub.{pub_id}'}
+                   for pub_id in query['ids'][0].split(',')]
+        body = json.dumps({'status': 'ok', 'records': records} if status == 200 else {'status': 'error'}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    handler = type('Handler', (StubIdConvHandler,), {'statuses': [], 'requests': []})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield handler, f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(base_url, **settings):
+    settings = {'requests_per_second': 0, 'backoff_seconds': 0.01, 'timeout': 2} | settings
+    return IdConvClient(base_url=base_url, **settings)
+
+
+def test_convert_splits_ids_into_chunks(stub):
+    handler, base_url = stub
+    client = make_client(base_url, chunk_size=2)
+    records, unresolved = client.convert(['1', '2', '3', '4', '5'], id_type='pmid')
+    client.close()
+    assert sorted(record['pmid'] for record in records) == ['1', '2', '3', '4', '5']
+    assert unresolved == []
+    assert sorted(query['ids'][0] for query in handler.requests) == ['1,2', '3,4', '5']
+    assert all(query['idtype'] == ['pmid'] and query['format'] == ['json'] for query in handler.requests)
+
+
+def test_convert_retries_retryable_statuses(stub):
+    handler, base_url = stub
+    handler.statuses.extend([503, 429])
+    client = make_client(base_url, max_retries=3)
+    records, unresolved = client.convert(['7'])
+    client.close()
+    assert [record['pmcid'] for record in records] == ['PMC7']
+    assert unresolved == []
+    assert len(handler.requests) == 3
+
+
+def test_convert_gives_up_after_max_retries(stub):
+    handler, base_url = stub
+    handler.statuses.extend([500] * 5)
+    client = make_client(base_url, max_retries=2)
+    records, unresolved = client.convert(['7', '8'])
+    client.close()
+    assert records == []
+    assert unresolved == ['7', '8']
+    assert len(handler.requests) == 3
+
+
+def test_convert_does_not_retry_client_errors(stub):
+    handler, base_url = stub
+    handler.statuses.append(400)
+    client = make_client(base_url, max_retries=3)
+    assert client.convert(['7']) == ([], ['7'])
+    client.close()
+    assert len(handler.requests) == 1
+
+
+def test_backoff_doubles_between_retries(stub):
+    handler, base_url = stub
+    handler.statuses.extend([503, 503])
+    client = make_client(base_url, max_retries=2, backoff_seconds=0.1)
+    start = time.monotonic()
+    client.convert(['7'])
+    client.close()
+    assert time.monotonic() - start >= 0.3
+
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(requests_per_second=20, burst=1)
+    start = time.monotonic()
+    for _ in range(5):
+        assert limiter.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_rate_limiter_gives_up_after_timeout():
+    limiter = RateLimiter(requests_per_second=1, burst=1)
+    assert limiter.acquire(timeout=0)
+    start = time.monotonic()
+    assert not limiter.acquire(timeout=0.1)
+    assert time.monotonic() - start < 0.1
+
+
+def test_rate_limit_wait_past_deadline_fails_chunk(stub):
+    handler, base_url = stub
+    client = make_client(base_url, requests_per_second=0.5, max_concurrency=1)
+    assert client.convert(['1'])[1] == []
+    start = time.monotonic()
+    assert client.convert(['2'], deadline=Deadline(0.2)) == ([], ['2'])
+    client.close()
+    assert time.monotonic() - start < 0.2
+    assert len(handler.requests) == 1
+
+
+def test_deadline_bounds_slow_calls(stub):
+    handler, base_url = stub
+    handler.latency = 0.5
+    client = make_client(base_url, max_retries=3)
+    start = time.monotonic()
+    assert client.convert(['7'], deadline=Deadline(0.1)) == ([], ['7'])
+    client.close()
+    assert time.monotonic() - start < 0.4
+
+
+def test_deadline_abandons_outstanding_chunks(stub):
+    handler, base_url = stub
+    handler.latency = 0.5
+    client = make_client(base_url, chunk_size=1, max_concurrency=1)
+    start = time.monotonic()
+    records, unresolved = client.convert(['1', '2', '3'], deadline=Deadline(0.2))
+    client.close()
+    assert records == []
+    assert sorted(unresolved) == ['1', '2', '3']
+    assert time.monotonic() - start < 0.4
+
+
+def test_circuit_breaker_opens_and_recovers(stub):
+    handler, base_url = stub
+    handler.statuses.extend([500, 500])
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.2)
+    client = make_client(base_url, max_retries=0, circuit_breaker=breaker)
+    assert client.convert(['1'])[1] == ['1']
+    assert client.convert(['2'])[1] == ['2']
+    assert breaker.state == 'open'
+    assert client.convert(['3'])[1] == ['3']
+    assert len(handler.requests) == 2
+    time.sleep(0.25)
+    assert breaker.state == 'half-open'
+    records, unresolved = client.convert(['4'])
+    client.close()
+    assert [record['pmid'] for record in records] == ['4'] and unresolved == []
+    assert breaker.state == 'closed'
+
+
+def test_circuit_breaker_counts_slow_calls():
+    breaker = CircuitBreaker(failure_threshold=2, slow_call_seconds=1)
+    breaker.record(True, elapsed=2)
+    breaker.record(True, elapsed=2)
+    assert breaker.state == 'open'
+    assert not breaker.allow()